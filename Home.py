@@ -1,8 +1,7 @@
 import streamlit as st
-import json
+from config import load_language_dictionary
 
-with open("language_dictionary.json", "r", encoding="utf-8") as archivo:
-    language_dictionary = json.load(archivo)
+language_dictionary = load_language_dictionary()
 
 st.set_page_config(page_title="StudySum AI", page_icon=":book:", initial_sidebar_state="expanded")
 
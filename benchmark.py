@@ -0,0 +1,474 @@
+"""
+Offline benchmark of the summarization, indexing and chat pipelines.
+
+The chat model, the embeddings and the YouTube loader are replaced by deterministic local stand-ins with a
+configurable latency and rate limits, and the inputs are synthetic PDFs and transcriptions, so the benchmark
+spends no API credits and gives the same numbers on every run. For each input size it reports the wall time,
+the LLM calls, the prompt and completion tokens, the embedding calls and the peak memory of every stage.
+The stand-ins count tokens by words, so no tokenizer is downloaded. Tracing the memory slows the stages down,
+so the peak memory is measured in a second pass, run in a new process with its own empty caches.
+
+With --startup it also measures the cold import time of the app modules and the rerun time of every page, and exits
+with an error when they exceed the given limits, so slow imports at startup are caught before they reach a deployment.
+
+Usage:
+    python benchmark.py --pages 5 50 500 --llm-latency 0.2 --output benchmark.jsonl
+    python benchmark.py --startup-only --max-startup-seconds 2 --max-rerun-seconds 0.5
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# The caches of the benchmark live in a temporary directory, so every run starts cold and the real caches are untouched
+# The directory is deleted when the benchmark exits, the memory pass gets its own one from 'measure_memory'
+if "STUDYSUM_CACHE_DIR" not in os.environ:
+    _cache_dir = tempfile.TemporaryDirectory(prefix="studysum-benchmark-", ignore_cleanup_errors=True)
+    os.environ["STUDYSUM_CACHE_DIR"] = _cache_dir.name
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+import chat_model
+import summary_model
+from embedding_models import LocalHashingEmbeddings
+from embedding_providers import register_embedding_provider
+from rate_limiter import RateLimiter, set_rate_limit
+from tokens import count_tokens, register_tokenizer
+from transcripts import LocalTranscriptLoader, set_transcript_loader
+from utils import extract_text, handle_long_text
+from vector_index import compare_index_types
+
+# Names of the stand-in models, used by the rate limiters and the caches
+FAKE_LLM_NAME = "fake-llm"
+FAKE_EMBEDDING_NAME = "fake-embedding"
+# Words of a synthetic page, about the length of a page of text
+WORDS_PER_PAGE = 450
+WORDS_PER_LINE = 12
+
+# Modules imported by the pages, measured by the startup check
+APP_MODULES = ("utils", "summary_model", "chat_model", "export", "transcripts", "dataframes", "config")
+# Streamlit scripts measured by the rerun check
+APP_PAGES = ("Home.py", "pages/PDFs.py", "pages/YoutubeVideos.py", "pages/Excel-CSV.py")
+
+VOCABULARY = ("the model summary document page chapter data analysis result method study value system process "
+              "information learning energy market policy history science student report figure table section "
+              "example question answer review network language context token index vector search memory "
+              "research design theory practice evidence growth change impact level group").split()
+
+
+class Counters:
+    """
+    Thread-safe counters of the calls made to the stand-in services.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}
+
+    def add(self, **amounts) -> None:
+        with self._lock:
+            for name, amount in amounts.items():
+                self.values[name] = self.values.get(name, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.values)
+
+
+counters = Counters()
+
+
+class FakeService:
+    """
+    Simulated remote API: every call waits a fixed latency, and the requests and tokens per minute are throttled
+    like a provider would do, so the waits caused by the provider limits show up in the wall time.
+    """
+
+    def __init__(self, latency: float = 0.0, rpm: int = None, tpm: int = None):
+        """
+        :param latency: Seconds each call takes
+        :param rpm: Requests per minute accepted by the service, None for no limit
+        :param tpm: Tokens per minute accepted by the service, None for no limit
+        """
+        self.latency = latency
+        self.limiter = RateLimiter(rpm, tpm) if rpm or tpm else None
+
+    def call(self, tokens: int) -> None:
+        """
+        :param tokens: Tokens of the request
+        """
+        if self.limiter is not None:
+            counters.add(throttled_seconds=self.limiter.acquire(tokens))
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class WordEncoder:
+    """
+    Tokenizer of the stand-in models, one token per word, so counting needs no downloaded encoding.
+    """
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return text.split()
+
+
+register_tokenizer(FAKE_LLM_NAME, WordEncoder())
+register_tokenizer(FAKE_EMBEDDING_NAME, WordEncoder())
+
+llm_service = FakeService()
+embedding_service = FakeService()
+
+
+class FakeLLM(LLM):
+    """
+    Deterministic stand-in for the chat model. The answer is built from the words of the prompt, so equal prompts get
+    equal answers, and its length is fixed by 'completion_words'.
+    """
+
+    model_name: str = FAKE_LLM_NAME
+    completion_words: int = 80
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        prompt_tokens = count_tokens(prompt, self.model_name)
+        llm_service.call(prompt_tokens)
+        words = prompt.split()
+        step = max(1, len(words) // self.completion_words)
+        answer = " ".join(words[::step][:self.completion_words])
+        counters.add(llm_calls=1, prompt_tokens=prompt_tokens,
+                     completion_tokens=count_tokens(answer, self.model_name))
+        return answer
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for a remote embedding model, computed on the CPU with 'LocalHashingEmbeddings'.
+    """
+
+    def __init__(self, dimension: int = 256):
+        self.embeddings = LocalHashingEmbeddings(dimension=dimension)
+
+    def embed_documents(self, texts: list) -> list:
+        tokens = sum(count_tokens(text, FAKE_EMBEDDING_NAME) for text in texts)
+        embedding_service.call(tokens)
+        counters.add(embedding_calls=1, embedding_texts=len(texts), embedding_tokens=tokens)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+class SlowTranscriptLoader(LocalTranscriptLoader):
+    """
+    'LocalTranscriptLoader' that takes a fixed time per load, like the network round trip to YouTube, and is
+    throttled to a number of loads per minute, like YouTube does with clients loading many transcripts.
+    """
+
+    def __init__(self, transcripts: dict, latency: float = 0.0, rpm: int = None):
+        """
+        :param transcripts: Dictionary from video ID to a (title, author, text) tuple
+        :param latency: Seconds each load takes
+        :param rpm: Loads per minute accepted, None for no limit
+        """
+        super().__init__(transcripts)
+        self.service = FakeService(latency, rpm)
+
+    def __call__(self, video_id: str, languages: tuple) -> list:
+        counters.add(transcript_loads=1)
+        self.service.call(0)
+        return super().__call__(video_id, languages)
+
+
+class SyntheticFile(io.BytesIO):
+    """
+    In-memory file with a name, like the files uploaded to Streamlit.
+    """
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+def synthetic_text(num_words: int, seed: int) -> str:
+    """
+    :param num_words: Number of words
+    :param seed: Seed of the generator, the same seed gives the same text
+    :return: Text of random words of VOCABULARY, with a full stop every few words
+    """
+    rng = random.Random(seed)
+    words = [rng.choice(VOCABULARY) for _ in range(num_words)]
+    for i in range(WORDS_PER_LINE - 1, num_words, WORDS_PER_LINE):
+        words[i] += "."
+    return " ".join(words)
+
+
+def synthetic_pdf(num_pages: int, seed: int) -> SyntheticFile:
+    """
+    :param num_pages: Number of pages
+    :param seed: Seed of the text
+    :return: PDF file with a page of synthetic text on every page
+    """
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    for page in range(num_pages):
+        words = synthetic_text(WORDS_PER_PAGE, seed * 100003 + page).split()
+        y = 750
+        for start in range(0, len(words), WORDS_PER_LINE):
+            pdf.drawString(40, y, " ".join(words[start:start + WORDS_PER_LINE]))
+            y -= 14
+        pdf.showPage()
+    pdf.save()
+    return SyntheticFile(buffer.getvalue(), f"synthetic-{num_pages}-pages.pdf")
+
+
+def fake_llm_choice(context_length: int, completion_words: int):
+    """
+    :return: Replacement of 'llm_choice' returning the stand-in LLM with the given context length
+    """
+    def llm_choice(llm_name: str, key: str, mode: str):
+        llm = FakeLLM(completion_words=completion_words)
+        return (llm, context_length) if mode == "sum" else llm
+    return llm_choice
+
+
+def run_stage(name: str, size: int, function, trace_memory: bool = False) -> dict:
+    """
+    Runs a stage of the benchmark and measures it.
+
+    :param name: Name of the stage
+    :param size: Size of the input, in pages
+    :param function: Function without arguments running the stage
+    :param trace_memory: Whether to measure the peak memory instead of the wall time, tracemalloc must be running
+    :return: Dictionary with the stage, the size, the wall seconds or the peak memory in MB, and the counters
+    """
+    before = counters.snapshot()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        function()
+        record = {"stage": name, "pages": size,
+                  "peak_memory_mb": round((tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20, 2)}
+    else:
+        start = time.perf_counter()
+        function()
+        record = {"stage": name, "pages": size, "wall_seconds": round(time.perf_counter() - start, 4)}
+    after = counters.snapshot()
+    for counter in ("llm_calls", "prompt_tokens", "completion_tokens", "embedding_calls", "embedding_tokens",
+                    "transcript_loads", "throttled_seconds"):
+        record[counter] = round(after.get(counter, 0) - before.get(counter, 0), 4)
+    return record
+
+
+def run_benchmark(pages: int, args) -> list:
+    """
+    Runs every stage with inputs of the given number of pages.
+
+    :param pages: Number of pages of the synthetic PDF and the transcription
+    :param args: Parsed command line arguments
+    :return: List of records, see 'run_stage'
+    """
+    lang, features = "in English", ""
+    pdf = synthetic_pdf(pages, seed=pages)
+    transcript = synthetic_text(pages * WORDS_PER_PAGE, seed=-pages)
+    video_id = f"video{pages:06d}"
+    set_transcript_loader(SlowTranscriptLoader({video_id: ("Synthetic video", "benchmark", transcript)},
+                                               args.transcript_latency, args.transcript_rpm))
+    link = f"https://www.youtube.com/watch?v={video_id}"
+    llm, context_length = summary_model.llm_choice("fake", "", "sum")
+    questions = [f"What does the document say about {word}?" for word in VOCABULARY[:args.questions]]
+
+    indexes = {}
+
+    def ingest():
+        indexes["pdf"] = chat_model.ingest("", [pdf], embedding_provider="Fake")
+
+    def chat():
+        for question in questions:
+            chat_model.get_response("fake", "", question, indexes["pdf"])
+
+    stages = [
+        ("extract_text", lambda: extract_text(pdf)),
+        ("summarization_chain", lambda: summary_model.summarization_chain("fake", "", [pdf], lang, features)),
+        ("handle_long_text", lambda: handle_long_text(llm, context_length, transcript, lang, "text", features)),
+        ("youtube_summarization", lambda: summary_model.youtube_summarization(
+            summary_model.get_youtube_transcript(link), "fake", "", lang)),
+        ("ingest", ingest),
+        ("get_response", chat)
+    ]
+    return [run_stage(name, pages, function, args.trace_memory) for name, function in stages]
+
+
+def measure_memory(argv: list) -> dict:
+    """
+    Runs the benchmark again with the same arguments in a new process with empty caches, tracing the memory.
+
+    :param argv: Command line arguments of this run
+    :return: Dictionary from (stage, pages) to the peak memory in MB
+    """
+    with tempfile.TemporaryDirectory(prefix="studysum-benchmark-", ignore_cleanup_errors=True) as cache_dir:
+        env = dict(os.environ, STUDYSUM_CACHE_DIR=cache_dir)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--trace-memory"], env=env,
+                                capture_output=True, text=True, check=True)
+    records = [json.loads(line) for line in output.stdout.splitlines() if line.startswith("{")]
+    return {(record["stage"], record["pages"]): record["peak_memory_mb"] for record in records}
+
+
+def measure_startup() -> dict:
+    """
+    Imports the app modules in a new interpreter, so nothing is already loaded, and measures the time it takes.
+
+    :return: Record with the 'startup' stage and its wall seconds
+    """
+    code = ("import time; start = time.perf_counter(); "
+            f"import {', '.join(APP_MODULES)}; "
+            "print(time.perf_counter() - start)")
+    root = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    return {"stage": "startup", "pages": None, "wall_seconds": round(float(output.stdout.strip().splitlines()[-1]), 4)}
+
+
+def measure_reruns(runs: int = 3) -> list:
+    """
+    Runs every page of the app with the Streamlit testing harness, first once and then 'runs' more times,
+    which is what happens on every interaction of a user.
+
+    :param runs: Number of reruns measured after the first run
+    :return: Records with the 'first_run:<page>' and 'rerun:<page>' stages, the rerun seconds being the mean
+    """
+    from streamlit.testing.v1 import AppTest
+    root = os.path.dirname(os.path.abspath(__file__))
+    records = []
+    for page in APP_PAGES:
+        app = AppTest.from_file(os.path.join(root, page), default_timeout=60)
+        start = time.perf_counter()
+        app.run()
+        first_run = time.perf_counter() - start
+        if app.exception:
+            raise RuntimeError(f"{page} failed: {app.exception[0].message}")
+        start = time.perf_counter()
+        for _ in range(runs):
+            app.run()
+        rerun = (time.perf_counter() - start) / runs
+        name = os.path.basename(page)
+        records.append({"stage": f"first_run:{name}", "pages": None, "wall_seconds": round(first_run, 4)})
+        records.append({"stage": f"rerun:{name}", "pages": None, "wall_seconds": round(rerun, 4)})
+    return records
+
+
+def check_limits(records: list, max_startup_seconds: float = None, max_rerun_seconds: float = None) -> list:
+    """
+    :param records: Records of 'measure_startup' and 'measure_reruns'
+    :param max_startup_seconds: Maximum cold import time, not checked if None
+    :param max_rerun_seconds: Maximum rerun time of every page, not checked if None
+    :return: Description of every limit exceeded
+    """
+    errors = []
+    for record in records:
+        if record["stage"] == "startup":
+            limit = max_startup_seconds
+        elif record["stage"].startswith("rerun:"):
+            limit = max_rerun_seconds
+        else:
+            continue
+        if limit is not None and record["wall_seconds"] > limit:
+            errors.append(f"{record['stage']} took {record['wall_seconds']} s, the limit is {limit} s")
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark of StudySum AI with local stand-ins.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[5, 50, 500],
+                        help="Sizes of the synthetic inputs, in pages")
+    parser.add_argument("--context-length", type=int, default=4097, help="Context length of the stand-in LLM")
+    parser.add_argument("--completion-words", type=int, default=80, help="Length of the answers of the stand-in LLM")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds of every LLM call")
+    parser.add_argument("--llm-rpm", type=int, default=3500, help="Requests per minute accepted by the LLM")
+    parser.add_argument("--llm-tpm", type=int, default=None, help="Tokens per minute accepted by the LLM")
+    parser.add_argument("--embedding-latency", type=float, default=0.02, help="Seconds of every embedding call")
+    parser.add_argument("--embedding-rpm", type=int, default=3000, help="Requests per minute of the embeddings")
+    parser.add_argument("--embedding-tpm", type=int, default=None, help="Tokens per minute of the embeddings")
+    parser.add_argument("--transcript-latency", type=float, default=0.1, help="Seconds of every transcript load")
+    parser.add_argument("--transcript-rpm", type=int, default=None, help="Transcript loads per minute accepted")
+    parser.add_argument("--questions", type=int, default=5, help="Number of chat questions")
+    parser.add_argument("--index-vectors", type=int, default=0,
+                        help="Also compare the index types on this many random vectors")
+    parser.add_argument("--no-memory", action="store_true", help="Do not run the pass measuring the peak memory")
+    parser.add_argument("--trace-memory", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--startup", action="store_true", help="Also measure the startup and rerun times")
+    parser.add_argument("--startup-only", action="store_true",
+                        help="Only measure the startup and rerun times, not the pipelines")
+    parser.add_argument("--reruns", type=int, default=3, help="Reruns of every page measured by the rerun check")
+    parser.add_argument("--max-startup-seconds", type=float, default=None,
+                        help="Fail if the cold import of the app modules takes longer")
+    parser.add_argument("--max-rerun-seconds", type=float, default=None,
+                        help="Fail if a rerun of any page takes longer")
+    parser.add_argument("--output", help="JSONL file where the records are written")
+    args = parser.parse_args()
+
+    records, errors = [], []
+    if not args.trace_memory and (args.startup or args.startup_only or args.max_startup_seconds is not None
+                                  or args.max_rerun_seconds is not None):
+        records = [measure_startup()] + measure_reruns(args.reruns)
+        errors = check_limits(records, args.max_startup_seconds, args.max_rerun_seconds)
+
+    global llm_service, embedding_service
+    llm_service = FakeService(args.llm_latency, args.llm_rpm, args.llm_tpm)
+    embedding_service = FakeService(args.embedding_latency, args.embedding_rpm, args.embedding_tpm)
+    set_rate_limit(FAKE_LLM_NAME, args.llm_rpm, args.llm_tpm)
+    set_rate_limit(FAKE_EMBEDDING_NAME, args.embedding_rpm, args.embedding_tpm)
+    register_embedding_provider("Fake", FAKE_EMBEDDING_NAME, lambda key: FakeEmbeddings())
+    summary_model.llm_choice = chat_model.llm_choice = fake_llm_choice(args.context_length, args.completion_words)
+
+    if args.trace_memory:
+        tracemalloc.start()
+        for pages in args.pages:
+            for record in run_benchmark(pages, args):
+                print(json.dumps(record))
+        return
+    for pages in [] if args.startup_only else args.pages:
+        records.extend(run_benchmark(pages, args))
+    if args.pages and not args.startup_only and not args.no_memory:
+        peaks = measure_memory(sys.argv[1:])
+        for record in records:
+            if (record["stage"], record["pages"]) in peaks:
+                record["peak_memory_mb"] = peaks[(record["stage"], record["pages"])]
+    if args.index_vectors and not args.startup_only:
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((args.index_vectors, 128)).astype(np.float32)
+        queries = rng.standard_normal((100, 128)).astype(np.float32)
+        for report in compare_index_types(vectors, queries):
+            records.append(dict(report, stage="index_" + report["index_type"], pages=None))
+
+    columns = ("stage", "pages", "wall_seconds", "llm_calls", "prompt_tokens", "completion_tokens",
+               "embedding_calls", "peak_memory_mb")
+    print(" | ".join(f"{column:>21}" for column in columns))
+    for record in records:
+        if "wall_seconds" in record:
+            print(" | ".join(f"{str(record.get(column, '')):>21}" for column in columns))
+        else:
+            print(f"{record['stage']:>21} | recall@k {record['recall_at_k']:.3f} | "
+                  f"{record['ms_per_query']:.3f} ms/query | build {record['build_seconds']:.2f} s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    if errors:
+        sys.exit("\n".join(errors))
+
+
+if __name__ == "__main__":
+    main()
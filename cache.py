@@ -0,0 +1,236 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import incr
+
+# Directory where every persistent cache of the app is stored
+CACHE_DIR = os.environ.get("STUDYSUM_CACHE_DIR", ".cache")
+
+
+def content_hash(*parts) -> str:
+    """
+    Returns a SHA-256 hex digest of the given parts. Strings are encoded as UTF-8 and every part is
+    separated, so ('ab', 'c') and ('a', 'bc') give different hashes.
+
+    :param parts: Strings or bytes to hash
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _entry_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def touch(path: str) -> None:
+    """
+    Marks an entry of a directory bounded by 'bound_directory' as recently used.
+
+    :param path: Path of the file or subdirectory
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def bound_directory(path: str, max_bytes: int, keep: tuple = ()) -> None:
+    """
+    Deletes the least recently used entries of a directory, files or subdirectories, until its total size is under
+    'max_bytes'. The recency of an entry is its modification time, which readers update with 'touch'.
+
+    :param path: Directory
+    :param max_bytes: Maximum total size of the entries
+    :param keep: Names of entries that are never deleted, e.g. the one just written
+    """
+    entries = []
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in names:
+        entry = os.path.join(path, name)
+        try:
+            entries.append((os.path.getmtime(entry), _entry_size(entry), name, entry))
+        except OSError:
+            continue
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, name, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name in keep:
+            continue
+        try:
+            shutil.rmtree(entry) if os.path.isdir(entry) else os.remove(entry)
+        except OSError:
+            continue
+        total -= size
+
+
+class DiskCache:
+    """
+    Persistent key-value store of binary values backed by SQLite.
+    The total size of the values is bounded, and the least recently used entries are evicted first.
+    Entries can optionally expire after a time to live. It is safe to share an instance between threads.
+    """
+
+    def __init__(self, name: str, max_bytes: int = 256 * 1024 * 1024, ttl: float = None):
+        """
+        :param name: Name of the database file inside CACHE_DIR
+        :param max_bytes: Maximum total size of the stored values
+        :param ttl: Seconds an entry stays valid, None for no expiration
+        """
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.name = name
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Returns the stored values of the keys that are in the cache and have not expired.
+
+        :param keys: List of keys
+        :return: Dictionary from key to value, missing keys are not included
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, value, created FROM entries WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = value
+            if found:
+                self._conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        incr("cache_hits", len(found), cache=self.name)
+        incr("cache_misses", len(keys) - len(found), cache=self.name)
+        return found
+
+    def get(self, key: str):
+        """
+        :param key: Key of the entry
+        :return: Stored value, or None if the key is missing or has expired
+        """
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: dict) -> None:
+        """
+        Stores several values and evicts the least recently used entries if the cache grows past 'max_bytes'.
+
+        :param items: Dictionary from key to value
+        """
+        now = time.time()
+        with self._lock:
+            for key, value in items.items():
+                row = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self._size -= row[0]
+                self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                   (key, value, len(value), now, now))
+                self._size += len(value)
+            self._evict()
+            self._conn.commit()
+
+    def set(self, key: str, value: bytes) -> None:
+        """
+        :param key: Key of the entry
+        :param value: Value to store
+        """
+        self.set_many({key: value})
+
+    def delete(self, key: str) -> None:
+        """
+        :param key: Key of the entry to remove
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._size -= row[0]
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._conn.commit()
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            expired = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE created < ?",
+                                         (time.time() - self.ttl,)).fetchone()[0]
+            if expired:
+                self._conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+                self._size -= expired
+        while self._size > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                self._size = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    break
+
+
+class MemoryCache:
+    """
+    Small thread-safe in-memory LRU cache, for values that are cheap to keep but expensive to compute.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        """
+        :param max_entries: Maximum number of entries kept
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: Key of the entry
+        :return: Stored value, or None if the key is missing
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value) -> None:
+        """
+        Stores a value and evicts the least recently used entry if the cache is full.
+
+        :param key: Key of the entry
+        :param value: Value to store
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -1,105 +1,467 @@
-import time
-
-from langchain.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.chains import RetrievalQA
-from langchain.memory import ConversationBufferWindowMemory
-
-from utils import llm_choice, extract_text
-import streamlit as st
-vector_store = None
-
-
-def ingest(key: str, files_list=None, video_text=None) -> None:
-    """
-    Adds PDFs or videos to a vector store through embeddings.
-    For files, it extracts text from each one and concatenates them.
-    For videos, the text should be provided via the `video_text` parameter, which is obtained beforehand
-    by calling the transcription function.
-
-    The text is then divided into chunks. These chunks are further divided into batches, with each batch containing
-    180 chunks. This is done to ensure that the API processes each batch with a time interval between them since there
-    is a limit on the number of calls a user can make per minute.
-
-    If there is only one batch with 180 chunks, it is used to ingest into the vector store. If the vector store has been
-    populated before, a new vector store is created and merged with the existing one. If there are multiple batches,
-    they are processed one by one with a 60-second interval between them. Each batch generates a separate vector store,
-    and these vector stores are stored in a list.
-
-    If the `vector_store` is `None`, it will take the first element from the list as the initial vector store and
-    proceed to merge it with the others. If it is not `None`, it will use the existing vector store and merge it
-    with all the elements from the list.
-
-    :param key: OpenAI key used for the embeddings
-    :param files_list: List of files that the user uploads
-    :param video_text: Text of the transcription of the YouTube video
-    :return: None
-    """
-    global vector_store
-    if files_list is not None:
-        text = ""
-        for file in files_list:
-            text_file = extract_text(file)
-            text += text_file
-
-    else:
-        text = video_text
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000,
-        chunk_overlap=100,
-        length_function=len
-    )
-
-    chunks = text_splitter.split_text(text)
-    batches = [chunks[i:i + 180] for i in range(0, len(chunks), 180)]
-
-    # HuggingFaceInstructEmbeddings(model_name="hkunlp/instructor-xl")
-    embeddings = OpenAIEmbeddings(openai_api_key=key)
-
-    if len(batches) == 1:
-        if vector_store is None:
-            vector_store = FAISS.from_texts(batches[0], embedding=embeddings)
-        else:
-            another_vector_store = FAISS.from_texts(batches[0], embedding=embeddings)
-            vector_store.merge_from(another_vector_store)
-    else:
-        vectorstore_list = []
-        for batch_index, batch in enumerate(batches):
-            vector_store_batch = FAISS.from_texts(batch, embedding=embeddings)
-            vectorstore_list.append(vector_store_batch)
-            if batch_index < len(batches) - 1:
-                time.sleep(61)
-
-        if vector_store is None:
-            vector_store = vectorstore_list[0]
-            start_index = 1
-        else:
-            start_index = 0
-        for vector in vectorstore_list[start_index:]:
-            vector_store.merge_from(vector)
-
-
-def get_response(llm_name: str, key: str, prompt: str) -> str:
-    """
-    Retrieves the response generated by the chosen Large Language Model (LLM) by specifying the LLM using 'llm_name.'
-    This process involves creating a memory that stores only the preceding message in the conversation.
-    The 'vector_store' serves as the retrieval mechanism, and the 'RetrievalQA' chain is utilized to extract
-    the response from the selected LLM.
-
-    :param llm_name: Name of the desired LLM.
-    :param key: OpenAI API key.
-    :param prompt: User's input prompt.
-    :return: Response generated by the LLM.
-    """
-    try:
-        llm = llm_choice(llm_name, key, "chat")
-        memory = ConversationBufferWindowMemory(k=1)
-        retriever = vector_store.as_retriever(search_kwargs={'k': 4})
-        qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, memory=memory)
-        response = qa.run(prompt)
-        return response
-    except Exception as e:
-        st.error(str(e))
-        st.stop()
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+
+from utils import llm_choice, iter_pages, count_pages, iter_chunks, stream_run
+from embedding_providers import EMBEDDING_PROVIDERS, get_embeddings
+from tokens import count_tokens
+from semantic_cache import SemanticCache
+from cache import MemoryCache, content_hash
+from metrics import span, bind
+import streamlit as st
+
+# Indexes of the documents loaded in memory, shared by every session that indexed the same documents
+DOCUMENT_STORES_CACHED = 64
+_document_stores = MemoryCache(max_entries=DOCUMENT_STORES_CACHED)
+# Two sessions may index the same document at the same time, this lock keeps them from saving it at once
+_save_lock = threading.Lock()
+answer_cache = SemanticCache(threshold=0.95, ttl=3600, max_entries=1000)
+# Chains kept by each session, the least recently used one is dropped when a new model, key or selection is used
+QA_CHAINS_PER_SESSION = 8
+
+qa_prompt = """Use the following pieces of context to answer the question at the end. If you don't know the answer, \
+just say that you don't know, don't try to make up an answer.
+
+{context}
+
+Previous conversation:
+{history}
+
+Question: {question}
+Helpful Answer:"""
+
+# Maximum number of tokens sent in a single embedding request
+EMBEDDING_BATCH_TOKENS = 20000
+# Maximum number of embedding requests running at the same time
+EMBEDDING_WORKERS = 4
+
+
+def token_batches(chunks, max_tokens: int = EMBEDDING_BATCH_TOKENS, model_name: str = "text-embedding-ada-002"):
+    """
+    Groups chunks into batches whose total number of tokens does not exceed 'max_tokens'.
+    A chunk longer than 'max_tokens' is sent alone in its own batch.
+
+    :param chunks: Iterable of text chunks
+    :param max_tokens: Token budget of each batch
+    :param model_name: Name of the embedding model the tokens are counted for
+    :return: Generator of lists of chunks
+    """
+    batch, batch_tokens = [], 0
+    for chunk in chunks:
+        chunk_tokens = count_tokens(chunk, model_name)
+        if batch and batch_tokens + chunk_tokens > max_tokens:
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += chunk_tokens
+    if batch:
+        yield batch
+
+
+def embed_stream(embeddings, batches, max_workers: int = EMBEDDING_WORKERS):
+    """
+    Embeds the batches concurrently and yields each batch with its vectors as soon as it is ready.
+    Only a few batches are in flight at the same time, so the batches can come from a lazy generator.
+
+    :param embeddings: Embeddings model
+    :param batches: Iterable of (tag, chunks) tuples, the tag tells the caller where the batch comes from
+    :param max_workers: Maximum number of requests running at the same time
+    :return: Generator of (tag, chunks, vectors) tuples, in completion order
+    """
+    def embed(batch: list) -> list:
+        with span("embed_batch"):
+            return embeddings.embed_documents(batch)
+
+    embed = bind(embed)
+    batches = iter(batches)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for tag, batch in batches:
+            pending[executor.submit(embed, batch)] = (tag, batch)
+            if len(pending) >= max_workers * 2:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tag, batch = pending.pop(future)
+                yield tag, batch, future.result()
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    pending[executor.submit(embed, next_batch[1])] = next_batch
+
+
+def index_documents(embeddings, documents: list, batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+                    progress_callback=None, model_name: str = "text-embedding-ada-002",
+                    total_pieces: int = None) -> list:
+    """
+    Builds the FAISS store of each document in a single pipelined pass.
+    The pieces of the text of each document (e.g. pages) are divided into chunks as they arrive, and the chunks are
+    grouped into batches sized by a token budget. Every chunk is identified by a hash of its document and its text,
+    so a chunk repeated inside a document (e.g. a header on every page) is embedded and stored only once.
+    The batches of all documents are embedded concurrently while the next pages are still being parsed, and the
+    vectors of each batch are added to the store of its document as soon as they arrive.
+
+    :param embeddings: Embeddings model
+    :param documents: List of (pieces, metadata) tuples, with the iterable of the pieces of the text of a document
+        and the metadata attached to every chunk of it, which includes the key of the document as 'document'
+    :param batch_tokens: Token budget of each embedding request
+    :param progress_callback: Optional function called as 'progress_callback(done, total_pieces, source)' with the
+        number of pieces read so far every time a batch is added. The pieces are read only a few batches ahead of the
+        embedding, so it follows the embedding closely
+    :param model_name: Name of the embedding model, used to count the tokens of the batches
+    :param total_pieces: Number of pieces of all the documents (e.g. pages), None if unknown
+    :return: List with the FAISS store of each document, None for a document whose text has no chunks
+    """
+    from langchain.vectorstores import FAISS
+
+    pieces_read = 0
+
+    def counted(pieces):
+        nonlocal pieces_read
+        for piece in pieces:
+            pieces_read += 1
+            yield piece
+
+    def unique_chunks(pieces, doc_key):
+        seen = set()
+        for chunk in iter_chunks(counted(pieces), chunk_size=2000, chunk_overlap=100):
+            chunk_id = content_hash(doc_key, chunk)
+            if chunk_id not in seen:
+                seen.add(chunk_id)
+                yield chunk
+
+    def tagged_batches():
+        for doc_index, (pieces, metadata) in enumerate(documents):
+            for batch in token_batches(unique_chunks(pieces, metadata["document"]), batch_tokens, model_name):
+                yield doc_index, batch
+
+    stores = [None] * len(documents)
+    for doc_index, batch, vectors in embed_stream(embeddings, tagged_batches()):
+        text_embeddings = list(zip(batch, vectors))
+        metadatas = [dict(documents[doc_index][1]) for _ in batch]
+        ids = [content_hash(metadatas[0]["document"], chunk) for chunk in batch]
+        if stores[doc_index] is None:
+            stores[doc_index] = FAISS.from_embeddings(text_embeddings, embedding=embeddings, metadatas=metadatas,
+                                                      ids=ids)
+        else:
+            stores[doc_index].add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        if progress_callback is not None:
+            progress_callback(pieces_read, total_pieces, documents[doc_index][1].get("source", ""))
+    return stores
+
+
+class DocumentIndex:
+    """
+    Documents indexed by a user session with one embedding provider. Every document has its own FAISS index, saved on
+    disk and shared by all the sessions that index the same document, so a session adding or removing documents never
+    changes what other sessions retrieve. Instances are not modified, 'ingest' returns a new one.
+    """
+
+    def __init__(self, provider: str, embeddings, documents: dict):
+        """
+        :param provider: Name of the embedding provider, a key of EMBEDDING_PROVIDERS
+        :param embeddings: Embeddings model of the provider, used for the questions
+        :param documents: Dictionary from the key of every document to its source, the file name or the video ID
+        """
+        self.provider = provider
+        self.embeddings = embeddings
+        self.documents = documents
+
+    def select(self, documents=None) -> list:
+        """
+        :param documents: Keys of some of the documents, all the documents if None or empty
+        :return: Sorted keys of the selected documents that are in the index
+        """
+        return sorted(doc_key for doc_key in documents or self.documents if doc_key in self.documents)
+
+    def scope_id(self, documents=None) -> str:
+        """
+        :param documents: Keys of the selected documents, all the documents if None or empty
+        :return: Identity of the selected documents, which only changes when they change
+        """
+        return content_hash(self.provider, *self.select(documents))
+
+    def missing(self, documents=None) -> list:
+        """
+        :param documents: Keys of the selected documents, all the documents if None or empty
+        :return: Sources of the selected documents whose index is no longer saved nor loaded, they are not searched
+            until they are indexed again
+        """
+        return [self.documents[doc_key] for doc_key in self.select(documents) if not document_available(doc_key)]
+
+
+def document_available(doc_key: str) -> bool:
+    """
+    :param doc_key: Key of the document
+    :return: Whether the index of the document is loaded or saved on disk
+    """
+    from vector_index import has_document_index
+    return _document_stores.get(doc_key) is not None or has_document_index(doc_key)
+
+
+def get_document_store(doc_key: str, embeddings):
+    """
+    Returns the FAISS store of a document, loaded from disk once and then kept in memory while it is used.
+
+    :param doc_key: Key of the document
+    :param embeddings: Embeddings model of the document
+    :return: FAISS store, or None if the saved index is gone
+    """
+    from vector_index import load_document_index
+    store = _document_stores.get(doc_key)
+    if store is None:
+        store = load_document_index(doc_key, embeddings)
+        if store is not None:
+            _document_stores.set(doc_key, store)
+    return store
+
+
+def ingest(key: str, files_list=None, video_text=None, video_id=None, videos=None,
+           embedding_provider: str = "OpenAI", progress_callback=None, index: DocumentIndex = None,
+           replace: bool = False) -> DocumentIndex:
+    """
+    Adds PDFs or videos to the document index of a user session through embeddings.
+    For files, each file is a separate document whose pages are extracted one by one.
+    For a video, the text should be provided via the `video_text` parameter, which is obtained beforehand
+    by calling the transcription function, and the `video_id` identifies the video. Several videos can be
+    provided at once via the `videos` parameter.
+
+    Every document has its own FAISS index saved on disk, keyed by a hash of the file content or the video ID.
+    Documents already in `index` are skipped, so indexing the same files again or adding one more file only embeds
+    the new ones, unless their saved index was deleted to bound the index directory. If another session indexed the
+    document before, its saved index is reused.
+    The rest are built together by 'index_documents', where the batches are embedded concurrently under the rate
+    limiter of the embedding model, which backs off when the API answers with a 429 error. Vectors are read from the
+    on-disk embedding cache when the same chunk was embedded before, so only new chunks reach the API. The embeddings
+    come from 'embedding_provider': the 'Local' provider embeds on the CPU without network calls or rate limits.
+    The index of every document is flat, the new ones are saved for the next time. Large selections of documents are
+    searched through one approximate index over all of them instead, see 'DocumentsRetriever'.
+
+    :param key: OpenAI key used for the embeddings
+    :param files_list: List of files that the user uploads
+    :param video_text: Text of the transcription of the YouTube video
+    :param video_id: ID of the YouTube video
+    :param videos: List of (video_id, video_text) tuples
+    :param embedding_provider: Name of the embedding provider, a key of EMBEDDING_PROVIDERS
+    :param progress_callback: Optional function receiving the progress of the embedding, see 'index_documents'
+    :param index: Document index of the session for the embedding provider, None or the index of another provider
+        to start a new one. Vectors of different providers cannot be compared, so each provider has its own index.
+    :param replace: Whether to remove from the index the documents that are not given, e.g. files no longer uploaded
+    :return: The new document index of the session
+    """
+    with span("ingest", provider=embedding_provider):
+        return _ingest(key, files_list, video_text, video_id, videos, embedding_provider, progress_callback, index,
+                       replace)
+
+
+def _ingest(key: str, files_list, video_text, video_id, videos, embedding_provider: str, progress_callback,
+            index: DocumentIndex, replace: bool) -> DocumentIndex:
+    from vector_index import document_key, save_document_index
+    if index is not None and index.provider != embedding_provider:
+        index = None
+    embedding_model = EMBEDDING_PROVIDERS[embedding_provider]["model"]
+    if files_list is not None:
+        documents = [(document_key(embedding_model, file=file), file, None, {"source": file.name})
+                     for file in files_list]
+    else:
+        videos = videos if videos is not None else [(video_id, video_text)]
+        documents = [(document_key(embedding_model, video_id=v_id, text=v_text), None, v_text,
+                      {"source": v_id or "video"}) for v_id, v_text in videos]
+
+    previous = {} if index is None else index.documents
+    indexed = {} if replace else dict(previous)
+    embeddings = index.embeddings if index is not None else get_embeddings(embedding_provider, key)
+    documents = list({document[0]: document for document in documents}.values())
+    indexed.update({doc_key: metadata["source"] for doc_key, _, _, metadata in documents if doc_key in previous})
+    documents = [document for document in documents
+                 if document[0] not in previous or not document_available(document[0])]
+    stores = [get_document_store(doc_key, embeddings) for doc_key, _, _, _ in documents]
+    missing = [i for i, store in enumerate(stores) if store is None]
+    total_pages = sum(count_pages(documents[i][1]) if documents[i][1] is not None else 1 for i in missing)
+    new_stores = index_documents(embeddings, [
+        (iter_pages(documents[i][1]) if documents[i][1] is not None else [documents[i][2]],
+         dict(documents[i][3], document=documents[i][0])) for i in missing
+    ], EMBEDDING_PROVIDERS[embedding_provider]["batch_tokens"], progress_callback, embedding_model, total_pages)
+    for i, store in zip(missing, new_stores):
+        if store is not None:
+            with _save_lock:
+                save_document_index(documents[i][0], store)
+            _document_stores.set(documents[i][0], store)
+        stores[i] = store
+    for (doc_key, _, _, metadata), store in zip(documents, stores):
+        if store is not None:
+            indexed[doc_key] = metadata["source"]
+    return DocumentIndex(embedding_provider, embeddings, indexed)
+
+
+def build_qa(llm_name: str, key: str, index: DocumentIndex, memory=None, documents=None):
+    """
+    Builds the 'RetrievalQA' chain over the documents of the session with the chosen LLM and a memory that stores
+    only the preceding message in the conversation. The memory feeds the 'history' of the prompt, so the previous turn
+    is taken into account in the answer. The retriever searches the index of every selected document, see
+    'DocumentsRetriever'.
+
+    :param llm_name: Name of the desired LLM.
+    :param key: OpenAI API key.
+    :param index: Document index of the session
+    :param memory: Memory of the conversation, a new one if None
+    :param documents: Keys of the documents the answer is taken from, all the documents if None
+    :return: RetrievalQA chain
+    """
+    from langchain.chains import RetrievalQA
+    from langchain.prompts import PromptTemplate
+    from vector_index import DocumentsRetriever
+    llm = llm_choice(llm_name, key, "chat")
+    if memory is None:
+        memory = new_memory()
+    retriever = DocumentsRetriever(embeddings=index.embeddings, documents=index.select(documents),
+                                   load_store=lambda doc_key: get_document_store(doc_key, index.embeddings), k=4)
+    prompt = PromptTemplate(input_variables=["history", "context", "question"], template=qa_prompt)
+    return RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever,
+                                       chain_type_kwargs={"prompt": prompt, "memory": memory})
+
+
+def new_memory():
+    """
+    :return: ConversationBufferWindowMemory that stores only the preceding message in the conversation
+    """
+    from langchain.memory import ConversationBufferWindowMemory
+    return ConversationBufferWindowMemory(k=1, memory_key="history", input_key="question")
+
+
+def get_conversation(conversation: str) -> tuple:
+    """
+    Returns the memory and the chains of a conversation of the user session, creating them on first use.
+    The session state is shared by all the pages, so every chat has its own conversation, e.g. 'pdf' and 'youtube'.
+
+    :param conversation: Name of the conversation
+    :return: Tuple of the ConversationBufferWindowMemory and the MemoryCache of the chains of the conversation
+    """
+    if "qa_conversations" not in st.session_state:
+        st.session_state.qa_conversations = {}
+    if conversation not in st.session_state.qa_conversations:
+        st.session_state.qa_conversations[conversation] = (new_memory(),
+                                                           MemoryCache(max_entries=QA_CHAINS_PER_SESSION))
+    return st.session_state.qa_conversations[conversation]
+
+
+def get_session_qa(llm_name: str, key: str, index: DocumentIndex, documents=None, conversation: str = "chat"):
+    """
+    Returns the 'RetrievalQA' chain of a conversation of the user session, built once for each model, key and
+    selection of documents and then reused across messages. All the chains of a conversation share its memory,
+    and only the most recently used chains are kept.
+
+    :param llm_name: Name of the desired LLM.
+    :param key: OpenAI API key.
+    :param index: Document index of the session
+    :param documents: Keys of the documents the answer is taken from, all the documents if None
+    :param conversation: Name of the conversation, see 'get_conversation'
+    :return: RetrievalQA chain
+    """
+    memory, chains = get_conversation(conversation)
+    chain_key = (llm_name, content_hash(key), index.scope_id(documents))
+    qa = chains.get(chain_key)
+    if qa is None:
+        qa = build_qa(llm_name, key, index, memory, documents)
+        chains.set(chain_key, qa)
+    return qa
+
+
+def reset_conversation(conversation: str = "chat") -> None:
+    """
+    Clears the memory of a conversation of the user session.
+
+    :param conversation: Name of the conversation, see 'get_conversation'
+    """
+    if conversation in st.session_state.get("qa_conversations", {}):
+        st.session_state.qa_conversations[conversation][0].clear()
+
+
+def cached_answer(llm_name: str, prompt: str, index: DocumentIndex, documents=None, memory=None):
+    """
+    Looks up the semantic answer cache for a question asked before, or a near-identical one, against the same
+    documents and model by any session. Once the conversation has history the answer depends on the previous turn
+    too, so the cache is skipped and the answer is not cached either.
+
+    :param llm_name: Name of the desired LLM.
+    :param prompt: User's input prompt.
+    :param index: Document index of the session
+    :param documents: Keys of the selected documents, all the documents if None
+    :param memory: Memory of the conversation, no history if None
+    :return: Tuple of the cached answer (None on a miss), the scope and the embedding of the question. The scope is
+        None when the answer must not be cached
+    """
+    if memory is not None and memory.load_memory_variables({})["history"]:
+        return None, None, None
+    scope = (index.scope_id(documents), llm_name)
+    question_vector = index.embeddings.embed_query(prompt)
+    return answer_cache.get(scope, question_vector), scope, question_vector
+
+
+def get_response(llm_name: str, key: str, prompt: str, index: DocumentIndex, documents=None,
+                 conversation: str = "chat") -> str:
+    """
+    Retrieves the response generated by the chosen Large Language Model (LLM) by specifying the LLM using 'llm_name.'
+    The chain of the user session is reused, with a memory that stores only the preceding message in the conversation.
+    The indexes of the documents serve as the retrieval mechanism, and the 'RetrievalQA' chain is utilized to extract
+    the response from the selected LLM. If the conversation has no history yet and the same or a very similar question
+    was already answered with the same documents and model, the cached answer is returned without calling the LLM, and
+    it is saved in the memory as if the LLM had given it, see 'cached_answer'.
+    The retrieval can be scoped to some of the indexed documents, e.g. a few of the uploaded files.
+
+    :param llm_name: Name of the desired LLM.
+    :param key: OpenAI API key.
+    :param prompt: User's input prompt.
+    :param index: Document index of the session, as returned by 'ingest'
+    :param documents: Keys of some of the documents of the index the answer is taken from, all if None
+    :param conversation: Name of the conversation of the session the question belongs to, see 'get_conversation'
+    :return: Response generated by the LLM.
+    """
+    try:
+        with span("get_response", model=llm_name):
+            memory = get_conversation(conversation)[0]
+            response, scope, question_vector = cached_answer(llm_name, prompt, index, documents, memory)
+            if response is None:
+                qa = get_session_qa(llm_name, key, index, documents, conversation)
+                response = qa.run(prompt)
+                if scope is not None:
+                    answer_cache.set(scope, question_vector, response)
+            else:
+                memory.save_context({"question": prompt}, {"text": response})
+        return response
+    except Exception as e:
+        st.error(str(e))
+        st.stop()
+
+
+def stream_response(llm_name: str, key: str, prompt: str, index: DocumentIndex, documents=None,
+                    conversation: str = "chat"):
+    """
+    Same as 'get_response', but yields the response as the LLM generates it, so it can be shown incrementally
+    with 'st.write_stream'. Cached answers are yielded at once.
+
+    :param llm_name: Name of the desired LLM.
+    :param key: OpenAI API key.
+    :param prompt: User's input prompt.
+    :param index: Document index of the session, as returned by 'ingest'
+    :param documents: Keys of some of the documents of the index the answer is taken from, all if None
+    :param conversation: Name of the conversation of the session the question belongs to, see 'get_conversation'
+    :return: Generator of the pieces of the response generated by the LLM.
+    """
+    try:
+        with span("get_response", model=llm_name):
+            memory = get_conversation(conversation)[0]
+            response, scope, question_vector = cached_answer(llm_name, prompt, index, documents, memory)
+            if response is not None:
+                memory.save_context({"question": prompt}, {"text": response})
+                yield response
+                return
+            qa = get_session_qa(llm_name, key, index, documents, conversation)
+            pieces = []
+            for piece in stream_run(lambda callbacks: qa.run(prompt, callbacks=callbacks)):
+                pieces.append(piece)
+                yield piece
+            if scope is not None:
+                answer_cache.set(scope, question_vector, "".join(pieces))
+    except Exception as e:
+        st.error(str(e))
+        st.stop()
@@ -0,0 +1,18 @@
+import json
+import os
+from functools import lru_cache
+
+# File with the texts of the app in Spanish and English, each key maps to [Spanish, English]
+LANGUAGE_DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "language_dictionary.json")
+
+
+@lru_cache(maxsize=1)
+def load_language_dictionary() -> dict:
+    """
+    Reads the language dictionary once per process, instead of on every rerun of every page.
+    The dictionary is shared by all sessions, so it must not be modified.
+
+    :return: Dictionary from text key to its [Spanish, English] translations
+    """
+    with open(LANGUAGE_DICTIONARY_PATH, "r", encoding="utf-8") as archivo:
+        return json.load(archivo)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING
+
+from cache import CACHE_DIR, MemoryCache, content_hash, bound_directory, touch
+
+# Directory where the parsed spreadsheets are cached
+FRAME_DIR = os.path.join(CACHE_DIR, "frames")
+# Maximum size of the cached spreadsheets on disk, the least recently used ones are deleted first
+FRAME_MAX_BYTES = 512 * 1024 * 1024
+# Number of rows read at a time from CSV files
+CSV_CHUNK_ROWS = 100000
+# Text columns whose fraction of distinct values is below this ratio are stored as categoricals
+CATEGORY_RATIO = 0.5
+# Number of rows shown in the preview of the data
+PREVIEW_ROWS = 200
+
+_frames = MemoryCache(max_entries=8)
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def downcast(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduces the memory of a DataFrame: integers and floats are downcast to the smallest type that holds their values.
+
+    :param df: DataFrame
+    :return: The same DataFrame with smaller numeric types
+    """
+    import pandas as pd
+    for column in df.select_dtypes(include="integer").columns:
+        df[column] = pd.to_numeric(df[column], downcast="integer")
+    for column in df.select_dtypes(include="float").columns:
+        df[column] = pd.to_numeric(df[column], downcast="float")
+    return df
+
+
+def to_categoricals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the text columns with few distinct values into categoricals.
+
+    :param df: DataFrame
+    :return: The same DataFrame with categorical columns
+    """
+    for column in df.select_dtypes(include="object").columns:
+        if len(df) and df[column].nunique(dropna=True) / len(df) < CATEGORY_RATIO:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def read_data_file(file) -> pd.DataFrame:
+    """
+    Parses an uploaded Excel or CSV file into a compact DataFrame.
+    CSV files are read in chunks of CSV_CHUNK_ROWS rows, each one downcast before the next is read,
+    so the full-width parse of a big file never has to be in memory at once.
+
+    :param file: Uploaded file
+    :return: DataFrame, or None if the file extension is not supported
+    """
+    import pandas as pd
+    file_extension = file.name.split(".")[-1].lower()
+    file.seek(0)
+    if file_extension == "xlsx":
+        df = downcast(pd.read_excel(file, engine='openpyxl'))
+    elif file_extension == "csv":
+        chunks = pd.read_csv(file, encoding='ISO-8859-1', chunksize=CSV_CHUNK_ROWS)
+        df = downcast(pd.concat((downcast(chunk) for chunk in chunks), ignore_index=True))
+    else:
+        return None
+    return to_categoricals(df)
+
+
+def load_dataframe(file, file_hash: str = None) -> pd.DataFrame:
+    """
+    Returns the DataFrame of an uploaded Excel or CSV file, parsed only once.
+    The parsed frame is cached in memory and on disk, keyed by a hash of the file content,
+    so reruns of the page and later uploads of the same file skip the parsing. The frames on disk are bounded
+    by FRAME_MAX_BYTES, the least recently used ones are deleted first. The returned frame is shared by every
+    session and must not be modified, callers that may change it work on a copy.
+
+    :param file: Uploaded file
+    :param file_hash: Hash of the file content, computed if not given
+    :return: DataFrame, or None if the file extension is not supported
+    """
+    file_hash = file_hash or content_hash(file.getvalue())
+    df = _frames.get(file_hash)
+    if df is not None:
+        return df
+    import pandas as pd
+    path = os.path.join(FRAME_DIR, f"{file_hash}.pkl")
+    if os.path.exists(path):
+        df = pd.read_pickle(path)
+        touch(path)
+    else:
+        df = read_data_file(file)
+        if df is None:
+            return None
+        os.makedirs(FRAME_DIR, exist_ok=True)
+        df.to_pickle(path, protocol=5)
+        bound_directory(FRAME_DIR, FRAME_MAX_BYTES, keep=(os.path.basename(path),))
+    _frames.set(file_hash, df)
+    return df
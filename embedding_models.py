@@ -0,0 +1,153 @@
+import re
+import time
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from cache import DiskCache, content_hash
+from metrics import record_usage
+from rate_limiter import is_rate_limit_error
+from tokens import count_tokens
+
+# Attempts made for a request rejected with a 429 error before giving up
+EMBEDDING_MAX_ATTEMPTS = 6
+# Maximum size of the on-disk embedding cache
+EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+_embedding_cache = None
+
+
+def get_embedding_cache() -> DiskCache:
+    """
+    Returns the process-wide embedding cache, creating it on first use.
+
+    :return: DiskCache holding float32 vectors
+    """
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = DiskCache("embeddings", max_bytes=EMBEDDING_CACHE_MAX_BYTES)
+    return _embedding_cache
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that sends every request through a rate limiter.
+    When the API answers with a 429 error, the limiter backs off and the request is retried with an exponential wait.
+    """
+
+    def __init__(self, embeddings: Embeddings, rate_limiter, model_name: str):
+        """
+        :param embeddings: Embeddings model that makes the API calls
+        :param rate_limiter: Shared limiter of the embedding model
+        :param model_name: Name of the embedding model, used to count the tokens of the requests
+        """
+        self.embeddings = embeddings
+        self.rate_limiter = rate_limiter
+        self.model_name = model_name
+
+    def _call(self, function, texts: list, tokens: int):
+        for attempt in range(EMBEDDING_MAX_ATTEMPTS):
+            self.rate_limiter.acquire(tokens)
+            try:
+                result = function(texts)
+                self.rate_limiter.recover()
+                record_usage(self.model_name, tokens, kind="embedding")
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == EMBEDDING_MAX_ATTEMPTS - 1:
+                    raise
+                self.rate_limiter.backoff()
+                time.sleep(2 ** attempt)
+
+    def embed_documents(self, texts: list) -> list:
+        tokens = sum(count_tokens(text, self.model_name) for text in texts)
+        return self._call(self.embeddings.embed_documents, texts, tokens)
+
+    def embed_query(self, text: str) -> list:
+        tokens = count_tokens(text, self.model_name)
+        return self._call(self.embeddings.embed_query, text, tokens)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that stores every vector in the on-disk embedding cache, keyed by a hash of the
+    embedding model and the text. Only the texts missing from the cache are sent to the wrapped model.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: DiskCache = None):
+        """
+        :param embeddings: Embeddings model used for the texts missing from the cache
+        :param model_name: Name of the embedding model, part of the cache key
+        :param cache: Cache to use, the process-wide embedding cache by default
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache if cache is not None else get_embedding_cache()
+
+    def embed_documents(self, texts: list) -> list:
+        keys = [content_hash(self.model_name, text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        vectors = [None] * len(texts)
+        for i, key in enumerate(keys):
+            if key in found:
+                vectors[i] = np.frombuffer(found[key], dtype=np.float32).tolist()
+        if missing:
+            new_vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            new_items = {}
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+                new_items[keys[i]] = np.asarray(vector, dtype=np.float32).tobytes()
+            self.cache.set_many(new_items)
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+class LocalHashingEmbeddings(Embeddings):
+    """
+    Local CPU embeddings that need no network and no API key.
+    Every text is turned into a bag of lowercase words and word bigrams, which are hashed into a fixed number of
+    dimensions with a random sign (the hashing trick). The counts are dampened with log(1 + count) and the vectors are
+    L2-normalized, so inner product and L2 distance rank the results the same way in FAISS.
+    A whole batch is vectorized at once with NumPy.
+    """
+
+    def __init__(self, dimension: int = 768):
+        """
+        :param dimension: Number of dimensions of the vectors
+        """
+        self.dimension = dimension
+        self._token_pattern = re.compile(r"\w+", re.UNICODE)
+
+    def _features(self, text: str) -> list:
+        words = self._token_pattern.findall(text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed_array(self, texts: list) -> np.ndarray:
+        """
+        Embeds a batch of texts.
+
+        :param texts: List of texts
+        :return: float32 array of shape (len(texts), dimension) with L2-normalized rows
+        """
+        features = [self._features(text) for text in texts]
+        vocabulary = {feature: index for index, feature in enumerate({f for fs in features for f in fs})}
+        hashes = np.array([zlib.crc32(feature.encode("utf-8")) for feature in vocabulary], dtype=np.int64)
+        columns = hashes % self.dimension
+        signs = np.where((hashes >> 31) & 1, -1.0, 1.0)
+        rows = np.repeat(np.arange(len(texts)), [len(fs) for fs in features])
+        feature_ids = np.fromiter((vocabulary[f] for fs in features for f in fs), dtype=np.int64, count=len(rows))
+        counts = np.bincount(rows * self.dimension + columns[feature_ids], weights=signs[feature_ids],
+                             minlength=len(texts) * self.dimension).reshape(len(texts), self.dimension)
+        vectors = (np.sign(counts) * np.log1p(np.abs(counts))).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def embed_documents(self, texts: list) -> list:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_array([text])[0].tolist()
@@ -0,0 +1,94 @@
+import re
+
+from rate_limiter import get_rate_limiter
+from tokens import register_tokenizer
+
+
+class WordTokenizer:
+    """
+    Tokenizer of the local embeddings, one token per word as 'LocalHashingEmbeddings' splits the texts,
+    so their batches are counted without downloading a tokenizer.
+    """
+
+    def __init__(self):
+        self._token_pattern = re.compile(r"\w+", re.UNICODE)
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return self._token_pattern.findall(text)
+
+
+def openai_embeddings(key: str):
+    """
+    Creates the OpenAI embeddings. The client library is imported here, the first time it is needed.
+
+    :param key: OpenAI API key
+    :return: OpenAIEmbeddings model
+    """
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    from utils import configure_http_pool
+    configure_http_pool()
+    return OpenAIEmbeddings(openai_api_key=key, model="text-embedding-ada-002", max_retries=1)
+
+
+def local_embeddings(key: str):
+    """
+    Creates the local hashing embeddings, which need no API key.
+
+    :param key: Unused, every factory receives the API key
+    :return: LocalHashingEmbeddings model
+    """
+    from embedding_models import LocalHashingEmbeddings
+    return LocalHashingEmbeddings(dimension=768)
+
+
+# Available embedding providers. 'remote' providers go through their rate limiter and the embedding cache,
+# 'batch_tokens' is the token budget of each embedding request.
+EMBEDDING_PROVIDERS = {
+    "OpenAI": {
+        "model": "text-embedding-ada-002", "remote": True, "batch_tokens": 20000,
+        "factory": openai_embeddings
+    },
+    "Local": {
+        "model": "local-hashing-768", "remote": False, "batch_tokens": 200000,
+        "factory": local_embeddings
+    }
+}
+# The local provider must work offline, so its batches are counted in words instead of a tiktoken encoding
+register_tokenizer(EMBEDDING_PROVIDERS["Local"]["model"], WordTokenizer())
+
+
+def register_embedding_provider(name: str, model_name: str, factory, remote: bool = True,
+                                batch_tokens: int = 20000, tokenizer=None) -> None:
+    """
+    Adds an embedding provider, e.g. 'HuggingFaceInstructEmbeddings(model_name="hkunlp/instructor-xl")'.
+
+    :param name: Name of the provider shown in the app
+    :param model_name: Name of the embedding model, part of the cache and index keys
+    :param factory: Function receiving the API key and returning an Embeddings model
+    :param remote: Whether the provider is an API with rate limits worth caching
+    :param batch_tokens: Token budget of each embedding request
+    :param tokenizer: Encoder counting the tokens of the model, see 'tokens.register_tokenizer'. Models without one
+        are counted with a tiktoken encoding, which is downloaded the first time
+    """
+    EMBEDDING_PROVIDERS[name] = {"model": model_name, "remote": remote, "batch_tokens": batch_tokens,
+                                 "factory": factory}
+    if tokenizer is not None:
+        register_tokenizer(model_name, tokenizer)
+
+
+def get_embeddings(provider: str, key: str):
+    """
+    Creates the embeddings of a provider. Remote providers are wrapped by the rate limiter of their model and the
+    on-disk embedding cache.
+
+    :param provider: Name of the provider, a key of EMBEDDING_PROVIDERS
+    :param key: API key of the provider, not needed by local providers
+    :return: Embeddings model
+    """
+    config = EMBEDDING_PROVIDERS[provider]
+    embeddings = config["factory"](key)
+    if config["remote"]:
+        from embedding_models import RateLimitedEmbeddings, CachedEmbeddings
+        embeddings = RateLimitedEmbeddings(embeddings, get_rate_limiter(config["model"]), config["model"])
+        embeddings = CachedEmbeddings(embeddings, config["model"])
+    return embeddings
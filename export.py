@@ -0,0 +1,172 @@
+import html
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+from cache import MemoryCache, content_hash
+
+# Maximum number of formats rendered at the same time
+EXPORT_WORKERS = 4
+
+_exports = MemoryCache(max_entries=64)
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+
+def split_fragments(summaries: str) -> list:
+    """
+    Splits the summaries into fragments separated by blank lines, each one a list of lines.
+
+    :param summaries: Summaries of all files
+    :return: List of fragments
+    """
+    return [fragment.split('\n') for fragment in summaries.strip().split('\n\n')]
+
+
+def render_pdf(summaries: str, title: str) -> bytes:
+    """
+    Renders the summaries as a PDF with the title on top.
+    Every fragment is a single paragraph whose lines are separated by line breaks, which keeps the number of
+    flowables reportlab has to lay out proportional to the fragments instead of the lines.
+
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :return: Content of the PDF file
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+    buffer = io.BytesIO()
+    styles = getSampleStyleSheet()
+    custom_style = ParagraphStyle(name='CustomStyle', parent=styles['Normal'])
+    custom_style.fontSize = 12
+
+    pdf = SimpleDocTemplate(buffer, pagesize=letter, title=title)
+    title_paragraph = Paragraph(escape(title), styles['Title'])
+    title_paragraph.alignment = 1
+    flowables = [title_paragraph]
+    fragments = split_fragments(summaries)
+    for i, lines in enumerate(fragments):
+        flowables.append(Paragraph("<br/>".join(escape(line) for line in lines), custom_style))
+        if i < len(fragments) - 1:
+            flowables.append(Spacer(1, 12))
+    pdf.build(flowables)
+    return buffer.getvalue()
+
+
+def render_docx(summaries: str, title: str) -> bytes:
+    """
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :return: Content of the Word file
+    """
+    from docx import Document
+    buffer = io.BytesIO()
+    doc = Document()
+    title_paragraph = doc.add_paragraph(title)
+    title_paragraph.runs[0].font.bold = True
+    title_paragraph.alignment = 1
+    doc.add_paragraph(summaries)
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def render_markdown(summaries: str, title: str) -> bytes:
+    """
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :return: Content of the Markdown file, UTF-8 encoded
+    """
+    fragments = ["  \n".join(lines) for lines in split_fragments(summaries)]
+    return (f"# {title}\n\n" + "\n\n".join(fragments) + "\n").encode("utf-8")
+
+
+def render_html(summaries: str, title: str) -> bytes:
+    """
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :return: Content of the HTML file, UTF-8 encoded
+    """
+    paragraphs = "\n".join("<p>" + "<br>".join(html.escape(line) for line in lines) + "</p>"
+                           for lines in split_fragments(summaries))
+    return (f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{html.escape(title)}</title>\n'
+            f'</head>\n<body>\n<h1>{html.escape(title)}</h1>\n{paragraphs}\n</body>\n</html>\n').encode("utf-8")
+
+
+# Available export formats: file extension, MIME type and function rendering (summaries, title) into bytes
+EXPORT_FORMATS = {
+    "PDF": {"extension": ".pdf", "mime": "application/pdf", "render": render_pdf},
+    "Word": {"extension": ".docx",
+             "mime": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+             "render": render_docx},
+    "Markdown": {"extension": ".md", "mime": "text/markdown", "render": render_markdown},
+    "HTML": {"extension": ".html", "mime": "text/html", "render": render_html}
+}
+
+
+def register_export_format(name: str, extension: str, mime: str, render) -> None:
+    """
+    Adds an export format. The render function must be defined at module level, so it can run in a worker process.
+
+    :param name: Name of the format shown in the app
+    :param extension: File extension, including the dot
+    :param mime: MIME type of the file
+    :param render: Function receiving the summaries and the title and returning the content of the file
+    """
+    EXPORT_FORMATS[name] = {"extension": extension, "mime": mime, "render": render}
+
+
+def get_export_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process-wide pool of rendering processes, creating it on first use and reusing it for every export.
+    The processes are spawned rather than forked, since the app process runs many threads.
+
+    :return: ProcessPoolExecutor
+    """
+    global _export_pool
+    with _export_pool_lock:
+        if _export_pool is None:
+            import multiprocessing
+            _export_pool = ProcessPoolExecutor(max_workers=min(EXPORT_WORKERS, os.cpu_count() or 1),
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _export_pool
+
+
+def export_documents(summaries: str, title: str, formats: list) -> dict:
+    """
+    Renders the summaries in the given formats, only when they are requested.
+    The rendered bytes are cached in memory by a hash of the summaries and the title, so reruns and repeated downloads
+    do not render them again. When several formats are missing from the cache and there is more than one CPU, they are
+    rendered concurrently by the pool of processes, see 'get_export_pool'.
+
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :param formats: Names of the formats, keys of EXPORT_FORMATS
+    :return: Dictionary from format name to the content of the file
+    """
+    document_hash = content_hash(summaries, title)
+    rendered = {name: _exports.get((name, document_hash)) for name in formats}
+    missing = [name for name, data in rendered.items() if data is None]
+    if len(missing) == 1 or (os.cpu_count() or 1) <= 1:
+        for name in missing:
+            rendered[name] = EXPORT_FORMATS[name]["render"](summaries, title)
+    elif missing:
+        executor = get_export_pool()
+        futures = {name: executor.submit(EXPORT_FORMATS[name]["render"], summaries, title) for name in missing}
+        for name, future in futures.items():
+            rendered[name] = future.result()
+    for name in missing:
+        _exports.set((name, document_hash), rendered[name])
+    return rendered
+
+
+def export_document(summaries: str, title: str, format_name: str) -> bytes:
+    """
+    :param summaries: Summaries of all files
+    :param title: Title of the document
+    :param format_name: Name of the format, a key of EXPORT_FORMATS
+    :return: Content of the file, see 'export_documents'
+    """
+    return export_documents(summaries, title, [format_name])[format_name]
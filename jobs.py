@@ -0,0 +1,168 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import bind
+
+# Number of jobs running at the same time in the process, the rest wait in the queue
+JOB_WORKERS = 4
+# Maximum number of queued or running jobs of a single user
+MAX_JOBS_PER_USER = 2
+# Seconds a finished job is kept so its result can still be polled
+JOB_RETENTION = 60 * 60
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when its cancellation has been requested.
+    """
+
+
+class JobLimitError(Exception):
+    """
+    Raised when a user submits a job while already having the maximum number of active jobs.
+    """
+
+
+class Job:
+    """
+    A long task running in the background worker pool, with its status, progress and result.
+    Status is one of 'queued', 'running', 'done', 'failed' or 'cancelled'.
+    """
+
+    def __init__(self, user_id: str, name: str):
+        """
+        :param user_id: Identifier of the user who submitted the job
+        :param name: Short description of the job
+        """
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.name = name
+        self.status = "queued"
+        self.done = 0
+        self.total = None
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished_at = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def fraction(self) -> float:
+        """
+        :return: Fraction of the job completed, 0 when the total is unknown
+        """
+        return min(1.0, self.done / self.total) if self.total else 0.0
+
+    def progress(self, done: int, total: int = None, message: str = "") -> None:
+        """
+        Reports the progress of the job. It is meant to be used as the progress callback of the task, and it is also
+        where cancellation takes effect: it raises JobCancelled once the job has been cancelled.
+
+        :param done: Units of work completed
+        :param total: Total units of work, None if unknown
+        :param message: Description of the current step
+        """
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.done, self.total, self.message = done, total, message
+
+    def cancel(self) -> None:
+        """
+        Requests the cancellation of the job. A queued job never starts, a running one stops at its next progress report.
+        """
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.status = "cancelled"
+            self.finished_at = time.time()
+
+
+class JobManager:
+    """
+    In-process background job runner: a pool of worker threads fed by a local queue, with per-user limits.
+    Jobs are independent of the Streamlit script run that submitted them, so reruns or closing the browser do not
+    stop them, and their status can be polled by ID.
+    """
+
+    def __init__(self, max_workers: int = JOB_WORKERS, max_jobs_per_user: int = MAX_JOBS_PER_USER):
+        """
+        :param max_workers: Number of jobs running at the same time
+        :param max_jobs_per_user: Maximum number of queued or running jobs of a single user
+        """
+        self.max_jobs_per_user = max_jobs_per_user
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: str, name: str, function) -> Job:
+        """
+        Queues a job.
+
+        :param user_id: Identifier of the user who submits the job
+        :param name: Short description of the job
+        :param function: Function receiving the Job, which can report progress through 'job.progress'
+        :return: The queued Job
+        """
+        with self._lock:
+            self._cleanup()
+            if len(self.active_jobs(user_id)) >= self.max_jobs_per_user:
+                raise JobLimitError(f"There are already {self.max_jobs_per_user} jobs running, wait for them to finish")
+            job = Job(user_id, name)
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(bind(self._run), job, function)
+        return job
+
+    @staticmethod
+    def _run(job: Job, function) -> None:
+        if job._cancel.is_set():
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            return
+        job.status = "running"
+        try:
+            job.result = function(job)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = e
+            job.status = "failed"
+        job.finished_at = time.time()
+
+    def get(self, job_id: str):
+        """
+        :param job_id: ID of the job
+        :return: The Job, or None if it does not exist or has expired
+        """
+        return self._jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id: str) -> None:
+        """
+        :param job_id: ID of the job to cancel
+        """
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def active_jobs(self, user_id: str) -> list:
+        """
+        :param user_id: Identifier of the user
+        :return: Queued and running jobs of the user
+        """
+        return [job for job in list(self._jobs.values()) if job.user_id == user_id and not job.finished]
+
+    def _cleanup(self) -> None:
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished and now - job.finished_at > JOB_RETENTION]:
+            del self._jobs[job_id]
+
+
+job_manager = JobManager()
@@ -0,0 +1,57 @@
+import queue
+import time
+
+from langchain_core.callbacks.base import BaseCallbackHandler
+
+from metrics import observe, incr, record_usage
+from tokens import count_tokens
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler that records the duration, the tokens and the cost of every call to an LLM in the metrics.
+    The tokens reported by the provider are used when available, otherwise they are counted.
+    """
+
+    def __init__(self, model_name: str):
+        """
+        :param model_name: Model name as used by the provider
+        """
+        self.model_name = model_name
+        self._calls = {}
+
+    def on_llm_start(self, serialized: dict, prompts: list, run_id=None, **kwargs) -> None:
+        self._calls[run_id] = (time.perf_counter(), sum(count_tokens(prompt, self.model_name) for prompt in prompts))
+
+    def on_chat_model_start(self, serialized: dict, messages: list, run_id=None, **kwargs) -> None:
+        prompt_tokens = sum(count_tokens(message.content, self.model_name)
+                            for conversation in messages for message in conversation)
+        self._calls[run_id] = (time.perf_counter(), prompt_tokens)
+
+    def on_llm_end(self, response, run_id=None, **kwargs) -> None:
+        start, prompt_tokens = self._calls.pop(run_id, (time.perf_counter(), 0))
+        observe("llm_call", time.perf_counter() - start, model=self.model_name)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            record_usage(self.model_name, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        else:
+            completion_tokens = sum(count_tokens(generation.text, self.model_name)
+                                    for generations in response.generations for generation in generations)
+            record_usage(self.model_name, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error: BaseException, run_id=None, **kwargs) -> None:
+        self._calls.pop(run_id, None)
+        incr("llm_errors", model=self.model_name)
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler that puts every new token generated by a streaming LLM into a queue.
+    """
+
+    def __init__(self, token_queue: queue.Queue):
+        self.token_queue = token_queue
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if token:
+            self.token_queue.put(token)
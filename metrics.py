@@ -0,0 +1,206 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# File where every timing span is appended as a JSON line, disabled when not set
+METRICS_LOG = os.environ.get("STUDYSUM_METRICS_LOG")
+# Number of user sessions whose metrics are kept in memory
+MAX_SESSIONS = 256
+# Prefix of the metric names in the Prometheus export
+PROMETHEUS_PREFIX = "studysum_"
+# Price in dollars per 1000 prompt and completion tokens of each model, used for the cost metric
+MODEL_PRICES = {
+    "gpt-3.5-turbo": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-3.5-turbo-16k": {"prompt": 0.003, "completion": 0.004},
+    "text-embedding-ada-002": {"prompt": 0.0001, "completion": 0.0}
+}
+
+_session_id = contextvars.ContextVar("metrics_session", default=None)
+_log_lock = threading.Lock()
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and timings, each identified by a name and a set of labels.
+    Recording is a dictionary update under a lock, so it can be done on every LLM call or cache lookup.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, amount: float = 1, labels: tuple = ()) -> None:
+        """
+        :param name: Name of the counter
+        :param amount: Amount added to the counter
+        :param labels: Sorted tuple of (label, value) pairs
+        """
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()) -> None:
+        """
+        :param name: Name of the timing
+        :param seconds: Duration observed
+        :param labels: Sorted tuple of (label, value) pairs
+        """
+        with self._lock:
+            count, total, maximum = self._timings.get((name, labels), (0, 0.0, 0.0))
+            self._timings[(name, labels)] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def snapshot(self) -> list:
+        """
+        :return: List of dictionaries, one per counter or timing, with its name, labels and values
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            timings = list(self._timings.items())
+        samples = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters]
+        samples += [{"name": name, "labels": dict(labels), "count": count, "seconds": total, "max_seconds": maximum}
+                    for (name, labels), (count, total, maximum) in timings]
+        return sorted(samples, key=lambda sample: (sample["name"], sorted(sample["labels"].items())))
+
+    def to_jsonl(self) -> str:
+        """
+        :return: The snapshot as JSON lines
+        """
+        return "".join(json.dumps(sample) + "\n" for sample in self.snapshot())
+
+    def to_prometheus(self) -> str:
+        """
+        :return: The snapshot in the Prometheus text exposition format. Counters are exported as '<name>_total' and
+            timings as '<name>_seconds_count' and '<name>_seconds_sum'.
+        """
+        lines = []
+        for sample in self.snapshot():
+            labels = ",".join(f'{label}="{_escape_label(value)}"' for label, value in sorted(sample["labels"].items()))
+            labels = "{" + labels + "}" if labels else ""
+            name = PROMETHEUS_PREFIX + sample["name"]
+            if "value" in sample:
+                lines.append(f"{name}_total{labels} {sample['value']}")
+            else:
+                lines.append(f"{name}_seconds_count{labels} {sample['count']}")
+                lines.append(f"{name}_seconds_sum{labels} {sample['seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+metrics = Metrics()
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def set_session(session_id: str) -> None:
+    """
+    Sets the session the metrics recorded from now on in this context are also attributed to.
+
+    :param session_id: Identifier of the user session
+    """
+    _session_id.set(session_id)
+
+
+def session_metrics(session_id: str) -> Metrics:
+    """
+    :param session_id: Identifier of the user session
+    :return: Metrics of the session, only the last MAX_SESSIONS sessions are kept
+    """
+    with _sessions_lock:
+        if session_id not in _sessions:
+            _sessions[session_id] = Metrics()
+            while len(_sessions) > MAX_SESSIONS:
+                _sessions.popitem(last=False)
+        _sessions.move_to_end(session_id)
+        return _sessions[session_id]
+
+
+def _targets() -> list:
+    session_id = _session_id.get()
+    return [metrics] if session_id is None else [metrics, session_metrics(session_id)]
+
+
+def incr(name: str, amount: float = 1, **labels) -> None:
+    """
+    Adds an amount to a counter of the process and of the current session.
+
+    :param name: Name of the counter, e.g. 'llm_calls'
+    :param amount: Amount added
+    :param labels: Labels of the counter, e.g. model='gpt-3.5-turbo'
+    """
+    labels = tuple(sorted(labels.items()))
+    for target in _targets():
+        target.incr(name, amount, labels)
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """
+    Records a duration in a timing of the process and of the current session, and in METRICS_LOG if it is set.
+
+    :param name: Name of the timing, e.g. 'extract_text'
+    :param seconds: Duration
+    :param labels: Labels of the timing
+    """
+    label_tuple = tuple(sorted(labels.items()))
+    for target in _targets():
+        target.observe(name, seconds, label_tuple)
+    if METRICS_LOG:
+        line = json.dumps({"time": time.time(), "name": name, "seconds": seconds, "labels": labels,
+                           "session": _session_id.get()})
+        with _log_lock, open(METRICS_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+@contextmanager
+def span(name: str, **labels):
+    """
+    Times the enclosed block, see 'observe'. The duration is recorded even if the block raises.
+
+    :param name: Name of the timing
+    :param labels: Labels of the timing
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def record_usage(model_name: str, prompt_tokens: int, completion_tokens: int = 0, kind: str = "llm") -> None:
+    """
+    Counts a call to a model with its tokens and its cost according to MODEL_PRICES.
+
+    :param model_name: Model name as used by the provider
+    :param prompt_tokens: Tokens of the prompt, or of the texts for embeddings
+    :param completion_tokens: Tokens of the completion
+    :param kind: 'llm' or 'embedding', the prefix of the calls counter
+    """
+    incr(f"{kind}_calls", model=model_name)
+    incr("prompt_tokens", prompt_tokens, model=model_name)
+    if completion_tokens:
+        incr("completion_tokens", completion_tokens, model=model_name)
+    prices = MODEL_PRICES.get(model_name)
+    if prices is not None:
+        incr("cost_dollars", (prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1000,
+             model=model_name)
+
+
+def bind(function):
+    """
+    Returns a version of the function that runs with the metrics session of the caller, for tasks submitted to
+    a pool of threads, which do not inherit it.
+
+    :param function: Function to run in another thread
+    :return: Wrapped function
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
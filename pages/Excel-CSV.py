@@ -1,14 +1,14 @@
 import streamlit as st
-from utils import llm_choice
-import json
-import time
-import pandas as pd
-from langchain.agents import create_pandas_dataframe_agent, AgentType
+from utils import llm_choice, stream_run, get_user_id, show_metrics_panel
+from metrics import set_session
+from config import load_language_dictionary
+from dataframes import load_dataframe, PREVIEW_ROWS
+from cache import content_hash
 
-with open("language_dictionary.json", "r", encoding="utf-8") as archivo:
-    language_dictionary = json.load(archivo)
+language_dictionary = load_language_dictionary()
 
 st.set_page_config(page_title="StudySum AI", page_icon=":book:", initial_sidebar_state="expanded")
+set_session(get_user_id())
 
 # Header
 first_col, second_col, third_col = st.columns([0.05, 0.15, 0.8])
@@ -24,23 +24,32 @@ if model_name.startswith("GPT"):
     key = st.sidebar.text_input("OpenAI API Key:", placeholder="sk-XXXXXXXXXXXXXXX", type='password')
 else:
     key = st.sidebar.text_input("Hugging Face API Key:", placeholder="hf_XXXXXXXXXXXXXXX", type='password')
+show_metrics_panel(language_dictionary["show_metrics"][index])
 
 uploaded_data_files = st.file_uploader(language_dictionary["data_upload"][index], type=["xlsx", "csv"])
 disabled_state = True
 df = None
 
 if uploaded_data_files:
-    file_extension = uploaded_data_files.name.split(".")[-1].lower()
-    if file_extension == "xlsx":
-        df = pd.read_excel(uploaded_data_files, engine='openpyxl')
-    elif file_extension == "csv":
-        df = pd.read_csv(uploaded_data_files, encoding='ISO-8859-1')
+    data_file_hash = content_hash(uploaded_data_files.getvalue())
+    df = load_dataframe(uploaded_data_files, data_file_hash)
     if df is not None:
-        st.write(df)
+        # Only a preview is rendered, the agent works with the whole data
+        st.dataframe(df.head(PREVIEW_ROWS))
+        st.caption(language_dictionary["data_preview"][index].format(shown=min(PREVIEW_ROWS, len(df)), rows=len(df),
+                                                                     columns=len(df.columns)))
         if key:
-            llm = llm_choice(model_name, key, "data")
-            agent = create_pandas_dataframe_agent(llm=llm, df=df, max_iterations=3,
-                                                  max_execution_time=20, agent_type=AgentType.OPENAI_FUNCTIONS)
+            # The agent is built once per session for each file, model and key. The code it runs can modify the
+            # DataFrame, so it gets its own copy and the cached one shared by the other sessions stays untouched
+            agent_key = (data_file_hash, model_name, content_hash(key))
+            if st.session_state.get("data_agent_key") != agent_key:
+                from langchain.agents import create_pandas_dataframe_agent, AgentType
+                llm = llm_choice(model_name, key, "data")
+                st.session_state.data_agent = create_pandas_dataframe_agent(
+                    llm=llm, df=df.copy(), max_iterations=3, max_execution_time=20, agent_type=AgentType.OPENAI_FUNCTIONS
+                )
+                st.session_state.data_agent_key = agent_key
+            agent = st.session_state.data_agent
             disabled_state = False
         else:
             st.error(language_dictionary["api_error"][index])
@@ -59,17 +68,10 @@ if prompt := st.chat_input(language_dictionary["write_message"][index], disabled
     with st.chat_message("user"):
         st.markdown(prompt)
     with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        full_response = ""
         try:
-            assistant_response = agent.run(prompt)
+            full_response = st.write_stream(stream_run(lambda callbacks: agent.run(prompt, callbacks=callbacks)))
         except Exception as e:
             st.error(str(e))
             st.stop()
-        for chunk in assistant_response.split():
-            full_response += chunk + " "
-            time.sleep(0.05)
-            message_placeholder.markdown(full_response + "▌")
-        message_placeholder.markdown(full_response)
     disabled_chat = False
     st.session_state.messages3.append({"role": "assistant", "content": full_response})
@@ -1,16 +1,19 @@
 import streamlit as st
-from summary_model import generate_document, extract_text, summarization_chain
-import time
-from chat_model import get_response, ingest
+from summary_model import extract_text, summarization_chain
+from export import EXPORT_FORMATS, export_documents
+from chat_model import stream_response, ingest, reset_conversation
+from utils import submit_job, follow_job, get_user_id, show_metrics_panel
+from metrics import set_session
+from functools import partial
 import datetime
-import json
+from config import load_language_dictionary
 
-from utils import llm_choice
+from tokens import count_tokens
 
-with open("language_dictionary.json", "r", encoding="utf-8") as archivo:
-    language_dictionary = json.load(archivo)
+language_dictionary = load_language_dictionary()
 
 st.set_page_config(page_title="StudySum AI", page_icon=":book:", initial_sidebar_state="expanded")
+set_session(get_user_id())
 
 # Header
 first_col, second_col, third_col = st.columns([0.05, 0.15, 0.8])
@@ -27,8 +30,8 @@ if model_name.startswith("GPT"):
     key = st.sidebar.text_input("OpenAI API Key:", placeholder="sk-XXXXXXXXXXXXXXX", type='password')
 else:
     key = st.sidebar.text_input("Hugging Face API Key:", placeholder="hf_XXXXXXXXXXXXXXX", type='password')
-
-llm = llm_choice(model_name, "api_key", 'llm')
+embedding_provider = st.sidebar.selectbox(language_dictionary["embeddings"][index], ('OpenAI', 'Local'))
+show_metrics_panel(language_dictionary["show_metrics"][index])
 
 uploaded_files = st.file_uploader(language_dictionary["doc_upload"][index], accept_multiple_files=True, type=["pdf"])
 disabled_state = False if uploaded_files else True
@@ -38,7 +41,7 @@ max_tokens = 0
 max_tokens_file = ""
 for file in uploaded_files:
     text_file = extract_text(file)
-    num_tokens = llm.get_num_tokens(text_file)
+    num_tokens = count_tokens(text_file, model_name)
     if num_tokens > max_tokens:
         max_tokens = num_tokens
         max_tokens_file = file.name
@@ -63,58 +66,85 @@ col_btn_1, col_btn_2 = st.columns([0.3, 0.7])
 btn_summary = col_btn_1.button(language_dictionary["doc_summary"][index], disabled=disabled_state)
 
 language_translated = "in Spanish" if language == "Español" else "in English"
-buffer_pdf, buffer_word = None, None
+
+
+# Background job: summarizes the files
+def summarize_documents(llm_name, api_key, files, lang, features, job):
+    return summarization_chain(llm_name, api_key, files, lang, features, progress_callback=job.progress)
+
+
 if btn_summary:
     if key:
-        try:
-            with st.spinner(language_dictionary["wait_message"][index]):
-                summary_text = summarization_chain(model_name, key, uploaded_files, language_translated, input_feature)
-                buffer_pdf = generate_document(summary_text, document_name, ".PDF")
-                buffer_word = generate_document(summary_text, document_name, ".DOCX")
-            st.success(language_dictionary["doc_success"][index], icon="✅")
-        except Exception as e:
-            st.error(str(e))
-            st.stop()
+        submit_job("summary_job", "summary", partial(summarize_documents, model_name, key, uploaded_files,
+                                                     language_translated, input_feature))
     else:
         st.error(language_dictionary["api_error"][index])
 
-# Download Documents
-if buffer_pdf is not None and buffer_word is not None:
-    st.download_button(label=language_dictionary["doc_download"][index] + " " + "PDF",
-                       data=buffer_pdf.getvalue(),
-                       file_name=f"{document_name}" + ".pdf")
-    st.download_button(label=language_dictionary["doc_download"][index] + " " + "Word",
-                       data=buffer_word.getvalue(),
-                       file_name=f"{document_name}" + ".docx")
-    buffer_pdf.close()
-    buffer_word.close()
+summary_job = follow_job("summary_job", language_dictionary["wait_message"][index],
+                         language_dictionary["job_cancel"][index], language_dictionary["job_cancelled"][index])
+
+# Download Documents, only the chosen formats are rendered
+if summary_job is not None:
+    st.success(language_dictionary["doc_success"][index], icon="✅")
+    export_formats = st.multiselect(language_dictionary["doc_formats"][index], list(EXPORT_FORMATS), default=["PDF"])
+    try:
+        exported = export_documents(summary_job.result, document_name, export_formats)
+    except Exception as e:
+        st.error(str(e))
+        st.stop()
+    for format_name in export_formats:
+        st.download_button(label=language_dictionary["doc_download"][index] + " " + format_name,
+                           data=exported[format_name],
+                           file_name=f"{document_name}" + EXPORT_FORMATS[format_name]["extension"],
+                           mime=EXPORT_FORMATS[format_name]["mime"])
 
 # Chat implementation
 if 'clicked' not in st.session_state:
     st.session_state.clicked = False
+# Index of the files of this session for each embedding provider, the chat only retrieves from them
+if 'chat_indexes' not in st.session_state:
+    st.session_state.chat_indexes = {}
+
+
+# Background job: indexes the files for the chat, removing the files indexed before that are no longer uploaded
+def index_documents(api_key, files, provider, chat_index, job):
+    return ingest(api_key, files, embedding_provider=provider, progress_callback=job.progress, index=chat_index,
+                  replace=True)
 
 
 def click_button():
     if key:
-        try:
-            with st.spinner(language_dictionary["wait_message"][index]):
-                ingest(key, uploaded_files)
-            st.success(language_dictionary["success_indexing_doc"][index])
-            st.session_state.clicked = True
-        except Exception as i:
-            st.error(str(i))
-            st.stop()
+        submit_job("index_job", "indexing", partial(index_documents, key, uploaded_files, embedding_provider,
+                                                    st.session_state.chat_indexes.get(embedding_provider)))
     else:
         st.error(language_dictionary["api_error"][index])
 
 
 col_btn_2.button(language_dictionary["doc_chat"][index], on_click=click_button, disabled=disabled_state)
 
+index_job = follow_job("index_job", language_dictionary["wait_message"][index],
+                       language_dictionary["job_cancel"][index], language_dictionary["job_cancelled"][index])
+if index_job is not None:
+    del st.session_state["index_job"]
+    st.session_state.chat_indexes[index_job.result.provider] = index_job.result
+    # Provider of the last files indexed
+    st.session_state.chat_provider = index_job.result.provider
+    st.success(language_dictionary["success_indexing_doc"][index])
+    st.session_state.clicked = True
+
 if st.session_state.clicked:
     if "messages" not in st.session_state:
         st.session_state.messages = []
     if st.button(language_dictionary["clean"][index]):
         st.session_state.messages = []
+        reset_conversation("pdf")
+    # The chat uses the files indexed with the selected provider, or the last ones indexed if there are none
+    chat_index = st.session_state.chat_indexes.get(embedding_provider,
+                                                   st.session_state.chat_indexes[st.session_state.chat_provider])
+    selected_documents = st.multiselect(language_dictionary["chat_documents"][index], list(chat_index.documents),
+                                        default=list(chat_index.documents), format_func=chat_index.documents.get)
+    if missing_documents := chat_index.missing(selected_documents):
+        st.warning(language_dictionary["chat_missing"][index].format(documents=", ".join(missing_documents)))
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
@@ -123,13 +153,7 @@ if st.session_state.clicked:
         with st.chat_message("user"):
             st.markdown(prompt)
         with st.chat_message("assistant"):
-            message_placeholder = st.empty()
-            full_response = ""
-            assistant_response = get_response(model_name, key, prompt)
-            for chunk in assistant_response.split():
-                full_response += chunk + " "
-                time.sleep(0.05)
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
+            full_response = st.write_stream(stream_response(model_name, key, prompt, chat_index,
+                                                            selected_documents, conversation="pdf"))
         disabled_chat = False
         st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -1,14 +1,17 @@
 import streamlit as st
-from summary_model import youtube_summarization, get_youtube_transcript
-import time
-from chat_model import get_response, ingest
-import json
-from utils import llm_choice
+from summary_model import youtube_summarization, get_youtube_transcript, get_youtube_video_id, \
+    youtube_batch_summarization, fetch_transcripts, parse_video_links
+from chat_model import stream_response, ingest, reset_conversation
+from utils import submit_job, follow_job, get_user_id, show_metrics_panel
+from metrics import set_session
+from functools import partial
+from config import load_language_dictionary
+from tokens import count_tokens
 
-with open("language_dictionary.json", "r", encoding="utf-8") as archivo:
-    language_dictionary = json.load(archivo)
+language_dictionary = load_language_dictionary()
 
 st.set_page_config(page_title="StudySum AI", page_icon=":book:", initial_sidebar_state="expanded")
+set_session(get_user_id())
 
 # Header
 first_col, second_col, third_col = st.columns([0.05, 0.15, 0.9])
@@ -26,8 +29,9 @@ if model_name.startswith("GPT"):
     key = st.sidebar.text_input("OpenAI API Key:", placeholder="sk-XXXXXXXXXXXXXXX", type='password')
 else:
     key = st.sidebar.text_input("Hugging Face API Key:", placeholder="hf_XXXXXXXXXXXXXXX", type='password')
+embedding_provider = st.sidebar.selectbox(language_dictionary["embeddings"][index], ('OpenAI', 'Local'))
+show_metrics_panel(language_dictionary["show_metrics"][index])
 
-llm = llm_choice(model_name, "api_key", 'llm')
 input_link = st.text_input("Youtube link:", placeholder="https://www.youtube.com/watch?XXXXXXXXX")
 disabled_state_link = True
 
@@ -35,7 +39,7 @@ disabled_state_link = True
 if input_link:
     yt_transcript_s = get_youtube_transcript(input_link)
     if yt_transcript_s != "fail":
-        num_tokens = llm.get_num_tokens(yt_transcript_s)
+        num_tokens = count_tokens(yt_transcript_s, model_name)
         st.info(language_dictionary["yt_token_message"][index]+str(num_tokens)+" tokens")
         disabled_state_link = False
     else:
@@ -46,21 +50,37 @@ else:
 # Summary button
 col_btn_1, col_btn_2 = st.columns([0.35, 0.65])
 btn_summary_yt = col_btn_1.button(language_dictionary["yt_summary"][index], disabled=disabled_state_link)
+
+
+# Background job: summarizes the video
+def summarize_video(transcript, llm_name, api_key, lang, job):
+    return youtube_summarization(transcript, llm_name, api_key, lang, progress_callback=job.progress)
+
+
 if btn_summary_yt:
     if key:
-        try:
-            with st.spinner(language_dictionary["wait_message"][index]):
-                response_yt = youtube_summarization(yt_transcript_s, model_name, key, language_translated)
-            st.write(response_yt)
-        except Exception as y:
-            st.error(str(y))
-            st.stop()
+        submit_job("yt_summary_job", "summary",
+                   partial(summarize_video, yt_transcript_s, model_name, key, language_translated))
     else:
         st.error(language_dictionary["api_error"][index])
 
+yt_summary_job = follow_job("yt_summary_job", language_dictionary["wait_message"][index],
+                            language_dictionary["job_cancel"][index], language_dictionary["job_cancelled"][index])
+if yt_summary_job is not None:
+    st.write(yt_summary_job.result)
+
 # Chat implementation
 if 'clicked2' not in st.session_state:
     st.session_state.clicked2 = False
+# Index of the videos of this session for each embedding provider, the chat only retrieves from them
+if 'yt_chat_indexes' not in st.session_state:
+    st.session_state.yt_chat_indexes = {}
+
+
+# Background job: adds the videos to the ones indexed before for the chat
+def index_videos(api_key, videos, provider, chat_index, job):
+    return ingest(api_key, videos=videos, embedding_provider=provider, progress_callback=job.progress,
+                  index=chat_index)
 
 
 def click_button():
@@ -68,14 +88,10 @@ def click_button():
         if key:
             yt_transcript_c = get_youtube_transcript(input_link)
             if yt_transcript_c != "fail":
-                try:
-                    with st.spinner(language_dictionary["wait_message"][index]):
-                        ingest(key, video_text=yt_transcript_c)
-                    st.success(language_dictionary["success_indexing_yt"][index])
-                    st.session_state.clicked2 = True
-                except Exception as iy:
-                    st.error(str(iy))
-                    st.stop()
+                submit_job("yt_index_job", "indexing", partial(
+                    index_videos, key, [(get_youtube_video_id(input_link), yt_transcript_c)], embedding_provider,
+                    st.session_state.yt_chat_indexes.get(embedding_provider)))
+                st.session_state.yt_index_message = "success_indexing_yt"
             else:
                 st.error(language_dictionary["yt_error"][index])
         else:
@@ -86,11 +102,84 @@ def click_button():
 
 col_btn_2.button(language_dictionary["yt_chat"][index], on_click=click_button, disabled=disabled_state_link)
 
+yt_index_job = follow_job("yt_index_job", language_dictionary["wait_message"][index],
+                          language_dictionary["job_cancel"][index], language_dictionary["job_cancelled"][index])
+if yt_index_job is not None:
+    del st.session_state["yt_index_job"]
+    st.session_state.yt_chat_indexes[yt_index_job.result.provider] = yt_index_job.result
+    # Provider of the last videos indexed
+    st.session_state.yt_chat_provider = yt_index_job.result.provider
+    st.success(language_dictionary[st.session_state.yt_index_message][index])
+    st.session_state.clicked2 = True
+
+# Batch mode: several videos or a playlist
+batch_videos = []
+with st.expander(language_dictionary["yt_batch"][index]):
+    input_links = st.text_area(language_dictionary["yt_batch_links"][index],
+                               placeholder="https://www.youtube.com/watch?XXXXXXXXX\nhttps://www.youtube.com/playlist?list=XXXXXXXXX")
+    if input_links:
+        try:
+            batch_ids = parse_video_links(input_links)
+            batch_transcripts = fetch_transcripts(batch_ids)
+        except Exception as b:
+            st.error(str(b))
+            st.stop()
+        batch_videos = [(video_id, transcript) for video_id, transcript in zip(batch_ids, batch_transcripts)
+                        if transcript is not None]
+        missing_videos = [video_id for video_id, transcript in zip(batch_ids, batch_transcripts) if transcript is None]
+        batch_tokens = sum(count_tokens(transcript, model_name) for _, transcript in batch_videos)
+        st.info(language_dictionary["yt_batch_token_message"][index].format(num_videos=len(batch_videos),
+                                                                             num_tokens=batch_tokens))
+        if missing_videos:
+            st.warning(language_dictionary["yt_batch_missing"][index].format(videos=", ".join(missing_videos)))
+
+    col_batch_1, col_batch_2 = st.columns([0.35, 0.65])
+    btn_summary_batch = col_batch_1.button(language_dictionary["yt_batch_summary"][index],
+                                           disabled=not batch_videos)
+    # Background job: summarizes the videos, returning each video ID with its summary
+    def summarize_videos(videos, llm_name, api_key, lang, job):
+        summaries = youtube_batch_summarization([transcript for _, transcript in videos], llm_name, api_key, lang,
+                                                progress_callback=job.progress)
+        return [(video_id, summary) for (video_id, _), summary in zip(videos, summaries)]
+
+    if btn_summary_batch:
+        if key:
+            submit_job("yt_batch_job", "batch summary",
+                       partial(summarize_videos, batch_videos, model_name, key, language_translated))
+        else:
+            st.error(language_dictionary["api_error"][index])
+
+    yt_batch_job = follow_job("yt_batch_job", language_dictionary["wait_message"][index],
+                              language_dictionary["job_cancel"][index], language_dictionary["job_cancelled"][index])
+    if yt_batch_job is not None:
+        for video_id, response_batch in yt_batch_job.result:
+            st.markdown(f"**https://www.youtube.com/watch?v={video_id}**")
+            st.write(response_batch)
+
+    def click_button_batch():
+        if key:
+            submit_job("yt_index_job", "indexing", partial(index_videos, key, batch_videos, embedding_provider,
+                                                           st.session_state.yt_chat_indexes.get(embedding_provider)))
+            st.session_state.yt_index_message = "success_indexing_yt_batch"
+        else:
+            st.error(language_dictionary["api_error"][index])
+
+    col_batch_2.button(language_dictionary["yt_batch_chat"][index], on_click=click_button_batch,
+                       disabled=not batch_videos)
+
 if st.session_state.clicked2:
     if "messages2" not in st.session_state:
         st.session_state.messages2 = []
     if st.button(language_dictionary["clean"][index]):
         st.session_state.messages2 = []
+        reset_conversation("youtube")
+    # The chat uses the videos indexed with the selected provider, or the last ones indexed if there are none
+    yt_chat_index = st.session_state.yt_chat_indexes.get(
+        embedding_provider, st.session_state.yt_chat_indexes[st.session_state.yt_chat_provider])
+    selected_videos = st.multiselect(language_dictionary["chat_documents"][index], list(yt_chat_index.documents),
+                                     default=list(yt_chat_index.documents), format_func=yt_chat_index.documents.get)
+    if missing_documents := yt_chat_index.missing(selected_videos):
+        st.warning(language_dictionary["chat_missing"][index].format(documents=", ".join(missing_documents)))
     for message in st.session_state.messages2:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
@@ -99,12 +188,6 @@ if st.session_state.clicked2:
         with st.chat_message("user"):
             st.markdown(prompt)
         with st.chat_message("assistant"):
-            message_placeholder = st.empty()
-            full_response = ""
-            assistant_response = get_response(model_name, key, prompt)
-            for chunk in assistant_response.split():
-                full_response += chunk + " "
-                time.sleep(0.05)
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
+            full_response = st.write_stream(stream_response(model_name, key, prompt, yt_chat_index,
+                                                            selected_videos, conversation="youtube"))
         st.session_state.messages2.append({"role": "assistant", "content": full_response})
@@ -0,0 +1,23 @@
+from pypdf import PdfReader
+
+# Runs in the PDF extraction processes of 'utils', which only import this module and pypdf
+
+# PDF last opened by this process, as a (path, PdfReader) tuple
+_opened_pdf = None
+
+
+def extract_pages(path: str, start: int, end: int) -> list:
+    """
+    Extracts the texts of a range of pages of a PDF. The process keeps the last PDF it opened,
+    so the file is read and parsed once per process instead of once per range.
+
+    :param path: Path of a copy of the PDF file
+    :param start: Index of the first page
+    :param end: Index after the last page
+    :return: List of the texts of the pages
+    """
+    global _opened_pdf
+    if _opened_pdf is None or _opened_pdf[0] != path:
+        _opened_pdf = (path, PdfReader(path))
+    pdf_reader = _opened_pdf[1]
+    return [pdf_reader.pages[i].extract_text() for i in range(start, end)]
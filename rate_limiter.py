@@ -0,0 +1,157 @@
+import threading
+import time
+
+from metrics import incr, observe
+
+# Requests per minute and tokens per minute allowed for each model. 'None' disables that limit.
+RATE_LIMITS = {
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 60000},
+    "gpt-3.5-turbo-16k": {"rpm": 3500, "tpm": 60000},
+    "mistralai/Mistral-7B-Instruct-v0.1": {"rpm": 60, "tpm": None},
+    "tiiuae/falcon-7b-instruct": {"rpm": 60, "tpm": None},
+    "text-embedding-ada-002": {"rpm": 3000, "tpm": 1000000}
+}
+DEFAULT_RATE_LIMIT = {"rpm": 60, "tpm": None}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for requests per minute and tokens per minute.
+    Both buckets start full and refill continuously, so short bursts are allowed while the average rate stays
+    under the provider limits. It is thread safe, so a single instance can be shared by a pool of workers.
+    """
+
+    def __init__(self, rpm: int = None, tpm: int = None, name: str = None):
+        """
+        :param rpm: Maximum requests per minute, None for no limit
+        :param tpm: Maximum tokens per minute, None for no limit
+        :param name: Name of the limited model, the waits of named limiters are recorded in the metrics
+        """
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Blocks until one request with the given number of tokens can be made without exceeding the limits.
+
+        :param tokens: Estimated tokens of the request (prompt plus completion)
+        :return: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                tokens_needed = min(tokens, self.tpm) if self.tpm else 0
+                wait_requests = (1 - self._requests) * 60 / self.rpm if self.rpm and self._requests < 1 else 0
+                wait_tokens = (tokens_needed - self._tokens) * 60 / self.tpm \
+                    if self.tpm and self._tokens < tokens_needed else 0
+                wait = max(wait_requests, wait_tokens)
+                if wait <= 0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens_needed
+                    break
+            time.sleep(wait)
+            waited += wait
+        if waited and self.name:
+            observe("rate_limit_wait", waited, model=self.name)
+        return waited
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    Rate limiter that lowers its limits when the provider answers with a 429 error and slowly raises them again
+    after successful requests, up to the configured limits.
+    """
+
+    def __init__(self, rpm: int = None, tpm: int = None, min_fraction: float = 0.1, name: str = None):
+        """
+        :param rpm: Maximum requests per minute, None for no limit
+        :param tpm: Maximum tokens per minute, None for no limit
+        :param min_fraction: Lowest fraction of the configured limits the limiter can back off to
+        :param name: Name of the limited model, see 'RateLimiter'
+        """
+        super().__init__(rpm, tpm, name)
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.min_fraction = min_fraction
+
+    def backoff(self) -> None:
+        """
+        Halves the current limits and empties the buckets after a rate limit error.
+        """
+        if self.name:
+            incr("rate_limit_errors", model=self.name)
+        with self._lock:
+            if self.rpm:
+                self.rpm = max(self.max_rpm * self.min_fraction, self.rpm / 2)
+                self._requests = 0.0
+            if self.tpm:
+                self.tpm = max(self.max_tpm * self.min_fraction, self.tpm / 2)
+                self._tokens = 0.0
+
+    def recover(self) -> None:
+        """
+        Raises the current limits by 10% after a successful request.
+        """
+        with self._lock:
+            if self.rpm:
+                self.rpm = min(self.max_rpm, self.rpm * 1.1)
+            if self.tpm:
+                self.tpm = min(self.max_tpm, self.tpm * 1.1)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Tells whether an exception raised by a provider client is a 429 (too many requests) error.
+
+    :param error: Exception raised by the client
+    :return: True if the request was rejected for exceeding the rate limits
+    """
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+def set_rate_limit(model_name: str, rpm: int = None, tpm: int = None) -> None:
+    """
+    Changes the limits of a model. The shared limiter of that model is rebuilt on its next use.
+
+    :param model_name: Model name as used by the provider
+    :param rpm: Maximum requests per minute, None for no limit
+    :param tpm: Maximum tokens per minute, None for no limit
+    """
+    with _limiters_lock:
+        RATE_LIMITS[model_name] = {"rpm": rpm, "tpm": tpm}
+        _limiters.pop(model_name, None)
+
+
+def get_rate_limiter(model_name: str) -> AdaptiveRateLimiter:
+    """
+    Returns the process-wide limiter of a model, so every task calling the same model shares one budget.
+
+    :param model_name: Model name as used by the provider
+    :return: Shared limiter of the model
+    """
+    with _limiters_lock:
+        if model_name not in _limiters:
+            limits = RATE_LIMITS.get(model_name, DEFAULT_RATE_LIMIT)
+            _limiters[model_name] = AdaptiveRateLimiter(limits["rpm"], limits["tpm"], name=model_name)
+        return _limiters[model_name]
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import incr
+
+
+class SemanticCache:
+    """
+    In-memory cache of answers keyed by the embedding of the question.
+    A question hits the cache when its cosine similarity with a cached question of the same scope (index identity and
+    model) reaches the threshold. Entries expire after a time to live, and the least recently used ones are evicted
+    when the cache is full. Changing the index identity invalidates every answer given for the previous one.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1000):
+        """
+        :param threshold: Minimum cosine similarity for two questions to share an answer
+        :param ttl: Seconds an answer stays valid
+        :param max_entries: Maximum number of cached answers
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        import numpy as np
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, scope: tuple, vector):
+        """
+        Returns the answer of the most similar cached question of the scope, if it is similar enough.
+
+        :param scope: Tuple identifying the index and the model the answer depends on
+        :param vector: Embedding of the question
+        :return: Cached answer, or None
+        """
+        import numpy as np
+        query = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items()
+                          if entry["scope"] == scope and now - entry["time"] <= self.ttl]
+            answer = None
+            if candidates:
+                similarities = np.stack([entry["vector"] for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    answer = entry["answer"]
+        incr("cache_hits" if answer is not None else "cache_misses", cache="answers")
+        return answer
+
+    def set(self, scope: tuple, vector, answer: str) -> None:
+        """
+        :param scope: Tuple identifying the index and the model the answer depends on
+        :param vector: Embedding of the question
+        :param answer: Answer to cache
+        """
+        with self._lock:
+            self._entries[self._next_id] = {"scope": scope, "vector": self._normalize(vector), "answer": answer,
+                                            "time": time.time()}
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -1,20 +1,23 @@
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain.document_loaders import YoutubeLoader
-
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-
-from utils import llm_choice, handle_long_text, extract_text
-from docx import Document
+from utils import llm_choice, handle_long_text, extract_text, iter_pages, count_pages, check_long_text, \
+    cached_summary, get_model_name, get_num_tokens, MAP_COMPLETION_TOKENS
+from rate_limiter import get_rate_limiter
+from cache import content_hash
+from export import export_document
+from metrics import span, bind
+from transcripts import fetch_transcript, fetch_transcripts, get_youtube_video_id, parse_video_links
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import io
+import threading
 import streamlit as st
 
+# Maximum number of files or videos summarized at the same time
+FILE_WORKERS = 4
+
+YT_MATTER = "youtube video transcription"
+YT_FEATURES = "Provide a concise summary of the video's key points, main ideas, and relevant information"
 
-prompt = PromptTemplate(
-    input_variables=["lang", "matter", "text", "features"],
-    template="""
+
+summary_prompt = """
     Write a detailed easy to understand summary {lang} of the {matter} enclosed in triple backticks.
     Additional summary features: {features}
     Note: The additional features might be in spanish or be empty, as they are part of user input. 
@@ -23,40 +26,103 @@ prompt = PromptTemplate(
     {text}
     '''
     """
-)
 
 
-def summarization_chain(llm_name: str, key: str, files_list: list, lang: str, features: str) -> str:
+def summarize_text(llm, context_length: int, pages, lang: str, matter: str, features: str,
+                   document_id: str = None, progress_callback=None, total_pieces: int = None) -> str:
+    """
+    Returns the summary of a single text given as a stream of pieces, such as the pages of a file.
+    The tokens are counted as the pieces arrive. If the text reaches a number of tokens greater than or equal to what
+    is allowed by the model, the 'handle_long_text' function will be used, where the remaining pieces keep streaming
+    into the chunk summaries without holding the whole text in memory. Otherwise, the text is summarized in a single
+    call that goes through the rate limiter of the model and the summary cache.
+    The 'document_id' lets 'handle_long_text' checkpoint the chunk summaries, so a failed run can be resumed, and
+    the 'progress_callback' follows its chunk summaries and can stop it.
+
+    :param llm: LLM model chosen before
+    :param context_length: The number of tokens a language model can process at once
+    :param pages: Iterable of the pieces of the text
+    :param lang: Chosen language
+    :param matter: What is being summarized, e.g. 'text'
+    :param features: Additional features for the summary
+    :param document_id: Hash of the content of the document
+    :param progress_callback: Optional function passed to 'handle_long_text' when the text is long
+    :param total_pieces: Number of pieces of the text, e.g. pages, used to estimate the progress of a long text
+    :return: Summary of the text
+    """
+    is_long, pieces = check_long_text(llm, pages, context_length)
+    if is_long:
+        # A list is already in memory and is given as it is, so the progress of the summary can be estimated
+        return handle_long_text(llm, context_length, pages if isinstance(pages, list) else pieces, lang, matter,
+                                features, document_id=document_id, progress_callback=progress_callback,
+                                total_pieces=total_pieces)
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+    text = "".join(pieces)
+    prompt = PromptTemplate(input_variables=["lang", "matter", "text", "features"], template=summary_prompt)
+    chain = LLMChain(llm=llm, prompt=prompt)
+    inputs = {'lang': lang, 'matter': matter, 'text': text, 'features': features}
+
+    def run() -> str:
+        get_rate_limiter(get_model_name(llm)).acquire(get_num_tokens(llm, text) + MAP_COMPLETION_TOKENS)
+        return chain.run(inputs)
+    return cached_summary(llm, prompt.template, inputs, run)
+
+
+def summarization_chain(llm_name: str, key: str, files_list: list, lang: str, features: str,
+                        progress_callback=None) -> str:
     """
     Obtains the summary of all files.
-    Firstly, it extracts the text from each file, then selects the model and retrieves the LLM and the context,
-    which is the number of tokens the model operates with.
-    If the extracted text has a number of tokens greater than or equal to what is allowed by the model,
-    the 'handle_long_text' function will be used to handle large files, where the text needs to be processed in parts.
-    This function returns the summary of that large file, which, along with the file's name,
-    is added to the summaries list. In case the text tokens are fewer than the allowed limit,
-    the summary of that file is obtained, and similarly, the file's name with its summary is added to the
-    'summaries' list. Finally, the summaries of all files in the 'summaries' list are concatenated and returned.
+    Firstly, it selects the model and retrieves the LLM and the context, which is the number of tokens the model
+    operates with. The same LLM client is shared by all files, and so is the rate limiter of the model.
+    Then, the files are summarized concurrently by a pool of threads through 'summarize_text', where the pages of
+    each file are extracted one by one.
+    Each summary, along with the file's name, is added to the summaries list in the original order of the files.
+    Finally, the summaries of all files in the 'summaries' list are concatenated and returned.
 
     :param llm_name: Name of the desired LLM.
     :param key: OpenAI API key.
     :param files_list: List of uploaded files
     :param lang: Chosen language
     :param features: Additional features for the summary
+    :param progress_callback: Optional function called as 'progress_callback(done, 100, name)' with the percentage
+        of all the files summarized so far, every time a chunk of a long file or a whole file is summarized. It is
+        also called from the threads summarizing the files. If it raises an exception (e.g. when a background job is
+        cancelled), the long files stop at their next chunk and the files not started yet are skipped
     :return: Summaries of all files
     """
     matter = "text"
-    summaries = []
-    for file in files_list:
-        text = extract_text(file)
-        llm, context_length = llm_choice(llm_name, key, "sum")
-        if llm.get_num_tokens(text) >= context_length:
-            long_response = handle_long_text(llm, context_length, text, lang, matter, features)
-            summaries.append([file.name, long_response])
-        else:
-            chain = LLMChain(llm=llm, prompt=prompt)
-            summaries.append([file.name, chain.run({'lang': lang, 'matter': matter,
-                                                    'text': text, 'features': features})])
+    llm, context_length = llm_choice(llm_name, key, "sum")
+    summaries = [None] * len(files_list)
+    # Fraction of each file summarized so far
+    fractions = [0.0] * len(files_list)
+    progress_lock = threading.Lock()
+
+    def report(i: int, fraction: float) -> None:
+        with progress_lock:
+            fractions[i] = fraction
+            percent = int(100 * sum(fractions) / len(files_list))
+        progress_callback(percent, 100, files_list[i].name)
+
+    def file_progress(i: int):
+        def callback(done: int, total: int, message: str) -> None:
+            report(i, min(done / total, 1.0) if total else fractions[i])
+        return callback if progress_callback is not None else None
+
+    with span("summarization_chain"), ThreadPoolExecutor(max_workers=FILE_WORKERS) as executor:
+        futures = {executor.submit(bind(summarize_text), llm, context_length, iter_pages(file), lang, matter, features,
+                                   content_hash(file.getvalue()), file_progress(i), count_pages(file)): i
+                   for i, file in enumerate(files_list)}
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                summaries[i] = [files_list[i].name, future.result()]
+                if progress_callback is not None:
+                    report(i, 1.0)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
     full_summary = ""
     for i, element in enumerate(summaries):
@@ -71,69 +137,28 @@ def summarization_chain(llm_name: str, key: str, files_list: list, lang: str, fe
 def generate_document(summaries: str, document_name: str, type_doc: str) -> io.BytesIO:
     """
     Generates a PDF or Word document based on the specified type.
-    The generated document is stored in a buffer and returned.
+    The document is rendered by the export subsystem, which caches it, and returned in a buffer.
 
     :param summaries: Summaries of all files
     :param document_name: Document's name
     :param type_doc: Document's type
     :return: io.BytesIO containing the generated document
     """
-
-    if type_doc == ".PDF":
-        buffer = io.BytesIO()
-        styles = getSampleStyleSheet()
-        custom_style = ParagraphStyle(name='CustomStyle', parent=styles['Normal'])
-        custom_style.fontSize = 12
-
-        pdf = SimpleDocTemplate(buffer, pagesize=letter, title=document_name)
-        summary_list = []
-
-        title = document_name
-        title_paragraph = Paragraph(title, styles['Title'])
-        title_paragraph.alignment = 1
-        summary_list.append(title_paragraph)
-        fragments = summaries.strip().split('\n\n')
-        for fragment in fragments:
-            fragment = fragment.replace('\n\n', '\n')
-            sub_fragments = fragment.split('\n')
-            for sub_fragment in sub_fragments:
-                paragraph = Paragraph(sub_fragment, custom_style)
-                summary_list.append(paragraph)
-            if fragment != fragments[-1]:
-                summary_list.append(Spacer(1, 12))
-        pdf.build(summary_list)
-        return buffer
-    else:
-        buffer = io.BytesIO()
-        doc = Document()
-        title = doc.add_paragraph(document_name)
-        title.runs[0].font.bold = True
-        title.alignment = 1
-        doc.add_paragraph(summaries)
-        doc.save(buffer)
-        return buffer
+    return io.BytesIO(export_document(summaries, document_name, "PDF" if type_doc == ".PDF" else "Word"))
 
 
 def get_youtube_transcript(link: str) -> str:
     """
     Retrieve the transcription of the YouTube video given its link.
+    The transcription is served from the transcript cache when the video was fetched before, so reruns of the page
+    do not go to the network again.
 
     :param link: YouTube video link
     :return: Transcription of the YouTube video
     """
     try:
-        loader = YoutubeLoader.from_youtube_url(
-            link, add_video_info=True, language=["en", "es"]
-        )
-        doc_yt = loader.load()
-        if doc_yt:
-            first_element = doc_yt[0]
-            title = first_element.metadata['title']
-            author = first_element.metadata['author']
-            yt_text = ''
-            for page in doc_yt:
-                yt_text += page.page_content.replace('\t', ' ')
-            yt_transcript = f"Tittle: {title}, Author: {author}, Transcription: {yt_text}"
+        yt_transcript = fetch_transcript(get_youtube_video_id(link))
+        if yt_transcript is not None:
             return yt_transcript
         else:
             return "fail"
@@ -142,7 +167,7 @@ def get_youtube_transcript(link: str) -> str:
         st.stop()
 
 
-def youtube_summarization(yt_transcript: str, llm_name: str, key: str, lang: str) -> str:
+def youtube_summarization(yt_transcript: str, llm_name: str, key: str, lang: str, progress_callback=None) -> str:
     """
     Returns the summary of the YouTube video.
     If the text of the transcription is longer than the model's context, the 'handle_long_text' function is called,
@@ -153,15 +178,44 @@ def youtube_summarization(yt_transcript: str, llm_name: str, key: str, lang: str
     :param llm_name: Name of the desired LLM.
     :param key: OpenAI API key.
     :param lang: Chosen language
+    :param progress_callback: Optional function following the chunk summaries of a long transcription, see
+        'handle_long_text'. If it raises an exception (e.g. when a background job is cancelled), the summary stops
     :return: Summary of the YouTube video
     """
-    matter = "youtube video transcription" 
-    yt_features = "Provide a concise summary of the video's key points, main ideas, and relevant information"
     llm, context_length = llm_choice(llm_name, key, "sum")
-    if llm.get_num_tokens(yt_transcript) >= context_length:
-        long_response_yt = handle_long_text(llm, context_length, yt_transcript, lang, matter, yt_features)
-        return long_response_yt
-    else:
-        chain = LLMChain(llm=llm, prompt=prompt)
-        yt_response = chain.run({'lang': lang, 'matter': matter, 'text': yt_transcript, 'features': yt_features})
-        return yt_response
+    with span("youtube_summarization"):
+        return summarize_text(llm, context_length, [yt_transcript], lang, YT_MATTER, YT_FEATURES,
+                              content_hash(yt_transcript), progress_callback)
+
+
+def youtube_batch_summarization(yt_transcripts: list, llm_name: str, key: str, lang: str,
+                                progress_callback=None) -> list:
+    """
+    Returns the summaries of several YouTube videos.
+    The videos are summarized concurrently with a shared LLM client, and every call goes through the rate limiter
+    of the model, so all the videos share one budget.
+
+    :param yt_transcripts: List of YouTube video transcriptions
+    :param llm_name: Name of the desired LLM.
+    :param key: OpenAI API key.
+    :param lang: Chosen language
+    :param progress_callback: Optional function called in the calling thread as 'progress_callback(done, total)'
+        every time a video is summarized. If it raises an exception, the videos not started yet are skipped
+    :return: List of summaries in the order of the transcriptions
+    """
+    llm, context_length = llm_choice(llm_name, key, "sum")
+    summaries = [None] * len(yt_transcripts)
+    with ThreadPoolExecutor(max_workers=FILE_WORKERS) as executor:
+        futures = {executor.submit(bind(summarize_text), llm, context_length, [yt_transcript], lang, YT_MATTER,
+                                   YT_FEATURES, content_hash(yt_transcript)): i
+                   for i, yt_transcript in enumerate(yt_transcripts)}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                summaries[futures[future]] = future.result()
+                if progress_callback is not None:
+                    progress_callback(done, len(yt_transcripts))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return summaries
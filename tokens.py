@@ -0,0 +1,107 @@
+from functools import lru_cache
+
+import tiktoken
+
+from cache import MemoryCache, content_hash
+
+# Texts shorter than this are counted directly, hashing them would cost about as much as encoding them
+MEMOIZE_MIN_LENGTH = 2000
+
+_token_counts = MemoryCache(max_entries=4096)
+# Encoders of models that do not use a tiktoken encoding, by lowercase model name, see 'register_tokenizer'
+_model_encoders = {}
+
+
+def register_tokenizer(model_name: str, encoder) -> None:
+    """
+    Sets the encoder used to count the tokens of a model, e.g. a local stand-in that must not download a tokenizer.
+
+    :param model_name: Model name, as passed to 'count_tokens'
+    :param encoder: Object with an 'encode(text, disallowed_special=())' method returning the tokens of the text
+    """
+    _model_encoders[model_name.lower()] = encoder
+
+
+def model_family(model_name: str) -> str:
+    """
+    Returns the tokenizer family of a model. Both the names shown in the app and the provider names are accepted.
+
+    :param model_name: Model name, e.g. 'GPT-3.5-turbo-16k', 'gpt-3.5-turbo' or 'mistralai/Mistral-7B-Instruct-v0.1'
+    :return: 'openai' for the OpenAI chat and embedding models, the model name for the models with a registered
+        encoder, 'huggingface' for the rest
+    """
+    name = model_name.lower()
+    if name in _model_encoders:
+        return name
+    return "openai" if name.startswith("gpt") or name.startswith("text-embedding") else "huggingface"
+
+
+def get_encoder(family: str):
+    """
+    Returns the encoder of a tokenizer family, loaded once per process.
+    The OpenAI models use 'cl100k_base'. The HuggingFace models are counted with the GPT-2 encoding,
+    the same approximation LangChain uses for them.
+
+    :param family: 'openai', 'huggingface' or the name of a model with a registered encoder
+    :return: tiktoken encoder, or the registered encoder
+    """
+    encoder = _model_encoders.get(family)
+    return encoder if encoder is not None else _tiktoken_encoder(family)
+
+
+@lru_cache(maxsize=None)
+def _tiktoken_encoder(family: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding("cl100k_base" if family == "openai" else "gpt2")
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    """
+    Returns the number of tokens of a text for a model.
+    Counts of long texts are memoized by a hash of the text, so widget interactions do not tokenize them again.
+
+    :param text: Text to count
+    :param model_name: Model name, see 'model_family'
+    :return: Number of tokens
+    """
+    family = model_family(model_name)
+    if len(text) < MEMOIZE_MIN_LENGTH:
+        return len(get_encoder(family).encode(text, disallowed_special=()))
+    key = (family, content_hash(text))
+    num_tokens = _token_counts.get(key)
+    if num_tokens is None:
+        num_tokens = len(get_encoder(family).encode(text, disallowed_special=()))
+        _token_counts.set(key, num_tokens)
+    return num_tokens
+
+
+def token_length_function(model_name: str):
+    """
+    Returns a length function for the text splitters that measures texts in tokens of a model.
+
+    :param model_name: Model name, see 'model_family'
+    :return: Function from text to number of tokens
+    """
+    encoder = get_encoder(model_family(model_name))
+    return lambda text: len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model_name: str) -> str:
+    """
+    Returns the longest prefix of a text that has at most 'max_tokens' tokens for a model.
+    The prefix is found by a binary search on its length, so it works with any registered encoder.
+
+    :param text: Text to truncate
+    :param max_tokens: Maximum number of tokens
+    :param model_name: Model name, see 'model_family'
+    :return: The text itself if it fits, otherwise its longest prefix that fits
+    """
+    if count_tokens(text, model_name) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle], model_name) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
@@ -0,0 +1,202 @@
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import DiskCache, content_hash
+from metrics import bind
+
+# Languages requested for the transcriptions, in order of preference
+TRANSCRIPT_LANGUAGES = ("en", "es")
+# Seconds a cached transcription stays valid and maximum size of the transcript cache
+TRANSCRIPT_CACHE_TTL = 24 * 60 * 60
+TRANSCRIPT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# Maximum number of transcriptions fetched at the same time
+TRANSCRIPT_WORKERS = 8
+# Seconds the videos of a playlist stay cached, shorter than the transcriptions since playlists change
+PLAYLIST_CACHE_TTL = 60 * 60
+PLAYLIST_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+_transcript_cache = None
+_playlist_cache = None
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def youtube_loader(video_id: str, languages: tuple) -> list:
+    """
+    Loads the transcription of a YouTube video with its title and author from YouTube.
+
+    :param video_id: YouTube video ID
+    :param languages: Languages of the transcription, in order of preference
+    :return: List of Documents with 'title' and 'author' in their metadata
+    """
+    from langchain.document_loaders import YoutubeLoader
+    return YoutubeLoader(video_id, add_video_info=True, language=list(languages)).load()
+
+
+class LocalTranscriptLoader:
+    """
+    Stand-in for 'youtube_loader' that serves transcriptions from memory, for tests and benchmarks without network.
+    It counts the loads of each video, so the caching and coalescing of the fetches can be checked.
+    """
+
+    def __init__(self, transcripts: dict):
+        """
+        :param transcripts: Dictionary from video ID to a (title, author, text) tuple
+        """
+        self.transcripts = transcripts
+        self.loads = {}
+
+    def __call__(self, video_id: str, languages: tuple) -> list:
+        self.loads[video_id] = self.loads.get(video_id, 0) + 1
+        if video_id not in self.transcripts:
+            return []
+        from langchain.schema import Document
+        title, author, text = self.transcripts[video_id]
+        return [Document(page_content=text, metadata={"title": title, "author": author})]
+
+
+transcript_loader = youtube_loader
+
+
+def set_transcript_loader(loader) -> None:
+    """
+    Replaces the function used to load the transcriptions, e.g. with a LocalTranscriptLoader.
+
+    :param loader: Function receiving a video ID and a tuple of languages and returning a list of Documents
+    """
+    global transcript_loader
+    transcript_loader = loader
+
+
+def get_transcript_cache() -> DiskCache:
+    """
+    Returns the process-wide cache of transcriptions, creating it on first use.
+
+    :return: DiskCache holding UTF-8 encoded transcriptions
+    """
+    global _transcript_cache
+    if _transcript_cache is None:
+        _transcript_cache = DiskCache("transcripts", max_bytes=TRANSCRIPT_CACHE_MAX_BYTES, ttl=TRANSCRIPT_CACHE_TTL)
+    return _transcript_cache
+
+
+def get_playlist_cache() -> DiskCache:
+    """
+    Returns the process-wide cache of the videos of the playlists, creating it on first use.
+
+    :return: DiskCache holding the video IDs of each playlist separated by new lines
+    """
+    global _playlist_cache
+    if _playlist_cache is None:
+        _playlist_cache = DiskCache("playlists", max_bytes=PLAYLIST_CACHE_MAX_BYTES, ttl=PLAYLIST_CACHE_TTL)
+    return _playlist_cache
+
+
+def get_youtube_video_id(link: str) -> str:
+    """
+    Returns the ID of a YouTube video given its link.
+
+    :param link: YouTube video link
+    :return: YouTube video ID
+    """
+    from langchain.document_loaders import YoutubeLoader
+    return YoutubeLoader.extract_video_id(link)
+
+
+def _load_transcript(video_id: str, languages: tuple):
+    doc_yt = transcript_loader(video_id, languages)
+    if not doc_yt:
+        return None
+    first_element = doc_yt[0]
+    title = first_element.metadata['title']
+    author = first_element.metadata['author']
+    yt_text = "".join(page.page_content.replace('\t', ' ') for page in doc_yt)
+    return f"Tittle: {title}, Author: {author}, Transcription: {yt_text}"
+
+
+def fetch_transcript(video_id: str, languages: tuple = TRANSCRIPT_LANGUAGES):
+    """
+    Returns the transcription of a YouTube video, with its title and author.
+    Transcriptions are cached on disk by video ID and languages. When several threads ask for the same video at the
+    same time, only the first one loads it and the rest wait for its result.
+
+    :param video_id: YouTube video ID
+    :param languages: Languages of the transcription, in order of preference
+    :return: Transcription, or None if the video has no transcription
+    """
+    cache = get_transcript_cache()
+    key = content_hash(video_id, ",".join(languages))
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8")
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _in_flight[key] = future
+    if not owner:
+        return future.result()
+    try:
+        transcript = _load_transcript(video_id, languages)
+        if transcript is not None:
+            cache.set(key, transcript.encode("utf-8"))
+        future.set_result(transcript)
+        return transcript
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+
+
+def get_playlist_video_ids(link: str) -> list:
+    """
+    Returns the IDs of the videos of a YouTube playlist given its link.
+    The videos are cached on disk by playlist link for a while, so reruns of the page do not go to the network again.
+
+    :param link: YouTube playlist link
+    :return: List of YouTube video IDs, in the order of the playlist
+    """
+    cache = get_playlist_cache()
+    key = content_hash(link)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8").split()
+    from pytube import Playlist
+    video_ids = [get_youtube_video_id(url) for url in Playlist(link).video_urls]
+    cache.set(key, "\n".join(video_ids).encode("utf-8"))
+    return video_ids
+
+
+def parse_video_links(links: str) -> list:
+    """
+    Returns the IDs of the videos of a list of YouTube links separated by new lines, spaces or commas.
+    Playlist links are expanded into their videos, and repeated videos are only kept once.
+
+    :param links: Text with YouTube video or playlist links
+    :return: List of YouTube video IDs, in the order of the links
+    """
+    video_ids = []
+    for link in re.split(r"[\s,]+", links.strip()):
+        if not link:
+            continue
+        if "list=" in link and "v=" not in link:
+            video_ids.extend(get_playlist_video_ids(link))
+        else:
+            video_ids.append(get_youtube_video_id(link))
+    return list(dict.fromkeys(video_ids))
+
+
+def fetch_transcripts(video_ids: list, languages: tuple = TRANSCRIPT_LANGUAGES) -> list:
+    """
+    Fetches the transcriptions of several YouTube videos concurrently through 'fetch_transcript'.
+
+    :param video_ids: List of YouTube video IDs
+    :param languages: Languages of the transcriptions, in order of preference
+    :return: List of transcriptions in the order of the video IDs, None for a video without transcription
+    """
+    with ThreadPoolExecutor(max_workers=TRANSCRIPT_WORKERS) as executor:
+        return list(executor.map(bind(lambda video_id: fetch_transcript(video_id, languages)), video_ids))
@@ -1,111 +1,680 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.llms import HuggingFaceHub
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.prompts import PromptTemplate
-from langchain.chains.summarize import load_summarize_chain
-from langchain.schema import Document
-import time
-from pypdf import PdfReader
-import streamlit as st
-
-
-def extract_text(file) -> str:
-    """
-    Extracts the text of a given PDF file.
-
-    :param file: Uploaded file
-    :return: Text of the file
-    """
-    text = ""
-    pdf_reader = PdfReader(file)
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    text = text.replace('\t', ' ')
-    return text
-
-
-def llm_choice(llm_name: str, key: str, mode: str):
-    """
-    Chooses the LLM model, available models: 'GPT-3.5-turbo-4k', 'GPT-3.5-turbo-16k', 'Mistral-7b', 'Falcon-7b'
-
-    :param llm_name: Chosen model name
-    :param key: OpenAI or HuggingFace key
-    :param mode: 'sum' for summarization task, 'chat' for chat task, 'data' for Excel or CSV docs, 'llm' for only llm
-    :return: Returns either the LLM alone or the LLM along with the context_length, depending on the mode. The chat task does not require the context_length since only summarization handles long text.
-    """
-    try:
-        models = {
-            "GPT-3.5-turbo-4k": ["gpt-3.5-turbo", 4097],
-            "GPT-3.5-turbo-16k": ["gpt-3.5-turbo-16k", 16385],
-            "Mistral-7b": ["mistralai/Mistral-7B-Instruct-v0.1", 8000],
-            "Falcon-7b": ["tiiuae/falcon-7b-instruct", 1200]
-        }
-        temperature_gpt, temperature_hf = (0, 0.1) if mode == "sum" or mode == "data" else (0.5, 0.5)
-        model_name = models[llm_name][0]
-        context_length = models[llm_name][1]
-        if model_name.startswith("gpt"):
-            llm = ChatOpenAI(temperature=temperature_gpt, model_name=model_name, openai_api_key=key)
-        else:
-            llm = HuggingFaceHub(
-                repo_id=model_name, model_kwargs={"temperature": temperature_hf, "max_new_tokens": 300},
-                huggingfacehub_api_token=key
-            )
-        if mode == "sum":
-            return llm, context_length
-        else:
-            return llm
-    except Exception as e:
-        st.error(str(e))
-        st.stop()
-
-
-map_prompt = """
-You will be given a single part of a {matter}. This section will be enclosed in triple backticks (```)
-Your goal is to write a very short easy to understand summary {lang}.
-```{text}```
-"""
-
-combine_prompt = """
-You will be given a series of summaries of a {matter}. The summaries will be enclosed in triple backticks (```)
-Your goal is to write a detailed easy to understand summary of the summaries {lang}.
-Additional summary features: {features}
-Note: The additional features might be in spanish or be empty, as they are part of user input. 
-Please take them into account and incorporate those features into your summary. 
-```{text}```
-"""
-
-
-def handle_long_text(llm, context_length: int, text: str, lang: str, matter: str, features: str) -> str:
-    """
-    Returns the summary of a very large PDF document.
-    Splits the text of the PDF into chunks, with each piece being processed to obtain a summary of them.
-    A waiting time of 60 seconds has been added after every 3 chunks to avoid the error of making too many API calls.
-    Then, each summary is taken, and the summary of these summaries is returned.
-
-    :param llm: LLM model chosen before
-    :param context_length: The number of tokens a language model can process at once
-    :param text: Text of the large PDF document
-    :param lang: Chosen language
-    :param matter: 'text' if it is a document summarization, 'data about a YouTube video transcription' if it is a YouTube video summarization
-    :param features: Additional features for the summaries
-    :return: Summary of the summaries of the large PDF document
-    """
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=context_length*3.3)
-    docs = text_splitter.create_documents([text])
-    map_prompt_template = PromptTemplate(template=map_prompt, input_variables=["text", "lang", "matter"])
-    combine_prompt_template = PromptTemplate(template=combine_prompt,
-                                             input_variables=["lang", "matter", "text", "features"])
-    map_chain = load_summarize_chain(llm=llm, chain_type="stuff", prompt=map_prompt_template)
-    summary_list = []
-    for index, doc in enumerate(docs):
-        chunk_summary = map_chain.run({'text': [doc], 'matter': matter, 'lang': lang, 'input_documents': [doc]})
-        if (index + 1) % 3 == 0:
-            if context_length not in (1200, 8000):
-                time.sleep(61)
-        summary_list.append(chunk_summary)
-    summaries = "\n".join(summary_list)
-    summaries = Document(page_content=summaries)
-
-    reduce_chain = load_summarize_chain(llm=llm, chain_type="stuff", prompt=combine_prompt_template)
-    return reduce_chain.run({'lang': lang, 'matter': matter,
-                             'text': [summaries], 'input_documents': [summaries], 'features': features})
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import chain
+from rate_limiter import get_rate_limiter
+from cache import DiskCache, MemoryCache, content_hash
+from tokens import count_tokens, token_length_function, truncate_tokens
+from jobs import job_manager
+from metrics import span, bind, session_metrics
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+
+# LangChain, FAISS, NumPy, pandas, pypdf and openai are imported inside the functions that use them, here and in the
+# modules the pages import, so a page only loads them when it first needs them and starts faster
+
+# Maximum number of chunk summaries requested at the same time, the rate limiter keeps them under the API limits
+MAX_WORKERS = 8
+# Expected length of a chunk summary, used to reserve tokens in the rate limiter
+MAP_COMPLETION_TOKENS = 500
+# Tokens kept free in every prompt for the language, matter and formatting
+MIN_PROMPT_MARGIN = 64
+# PDFs with at least this many pages are extracted by a pool of processes
+PARALLEL_EXTRACTION_PAGES = 64
+# Number of pages each process extracts at a time
+EXTRACTION_PAGES_PER_TASK = 32
+
+# Seconds a cached summary stays valid and maximum size of the summary cache
+SUMMARY_CACHE_TTL = 30 * 24 * 60 * 60
+SUMMARY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds the chunk summaries of an unfinished long summarization are kept and maximum size of the checkpoint store
+CHECKPOINT_TTL = 7 * 24 * 60 * 60
+CHECKPOINT_MAX_BYTES = 64 * 1024 * 1024
+
+# Maximum number of kept-alive connections to each API host
+HTTP_POOL_SIZE = 32
+# Attempts to reconnect made by a request whose connection fails, as the OpenAI client does by default
+HTTP_MAX_RETRIES = 2
+
+# Seconds between two updates of the progress of a background job
+JOB_POLL_INTERVAL = 0.5
+
+_extracted_texts = MemoryCache(max_entries=32)
+_summary_cache = None
+_checkpoint_store = None
+_llm_clients = MemoryCache(max_entries=32)
+_http_pool_lock = threading.Lock()
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+_http_pool_configured = False
+
+
+def _new_http_session():
+    """
+    Creates an HTTP session whose connection pool holds as many connections per host as requests run at once.
+
+    :return: requests.Session
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                          max_retries=HTTP_MAX_RETRIES)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def configure_http_pool() -> None:
+    """
+    Makes the OpenAI client create its HTTP sessions with a larger connection pool, so connections are kept alive
+    and reused across messages and reruns instead of paying a new TLS handshake every time.
+    The client keeps one session per thread and closes it after a few minutes, so it is given a factory instead of
+    a shared session that one thread could close while the others use it.
+    It is done once, the first time an OpenAI model is created.
+    """
+    global _http_pool_configured
+    with _http_pool_lock:
+        if _http_pool_configured:
+            return
+        import openai
+        openai.requestssession = _new_http_session
+        _http_pool_configured = True
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process-wide pool of PDF extraction processes, creating it on first use.
+    The processes are spawned rather than forked, since forking a process that runs many threads can copy
+    locks held by other threads, and they are reused by every extraction. They only import 'pdf_worker'.
+
+    :return: ProcessPoolExecutor
+    """
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            import multiprocessing
+            _extraction_pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        return _extraction_pool
+
+
+def _read_pages(data: bytes):
+    """
+    Yields the texts of the pages of a PDF as they are extracted.
+    Large PDFs are split into page ranges that are extracted in parallel by the pool of processes, when there is more
+    than one CPU, and the ranges are yielded in order as soon as they are ready. The file is written once to a
+    temporary copy the processes read, instead of being sent with every range.
+
+    :param data: Content of the PDF file
+    :return: Generator of the texts of the pages
+    """
+    from pypdf import PdfReader
+    pdf_reader = PdfReader(io.BytesIO(data))
+    num_pages = len(pdf_reader.pages)
+    if num_pages >= PARALLEL_EXTRACTION_PAGES and (os.cpu_count() or 1) > 1:
+        from pdf_worker import extract_pages
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+            pdf_file.write(data)
+        try:
+            starts = range(0, num_pages, EXTRACTION_PAGES_PER_TASK)
+            ends = [min(start + EXTRACTION_PAGES_PER_TASK, num_pages) for start in starts]
+            for pages in get_extraction_pool().map(extract_pages, [pdf_file.name] * len(starts), starts, ends):
+                yield from pages
+        finally:
+            os.remove(pdf_file.name)
+    else:
+        for page in pdf_reader.pages:
+            yield page.extract_text()
+
+
+def iter_pages(file):
+    """
+    Yields the text of a given PDF file page by page, so the whole text does not have to be held in memory
+    by the caller. The pages are cached in memory by a hash of the file content once the whole file has been read,
+    so the same upload is parsed only once across reruns and yields the same pieces whether it is cached or not.
+
+    :param file: Uploaded file
+    :return: Generator of the texts of the pages
+    """
+    data = file.getvalue()
+    file_hash = content_hash(data)
+    pages = _extracted_texts.get(file_hash)
+    if pages is not None:
+        yield from pages
+        return
+    pages = []
+    for page in _read_pages(data):
+        page = page.replace('\t', ' ')
+        pages.append(page)
+        yield page
+    _extracted_texts.set(file_hash, tuple(pages))
+
+
+def count_pages(file) -> int:
+    """
+    Counts the pages of a given PDF file without extracting their text, unless they are already cached.
+
+    :param file: Uploaded file
+    :return: Number of pages
+    """
+    data = file.getvalue()
+    pages = _extracted_texts.get(content_hash(data))
+    if pages is not None:
+        return len(pages)
+    from pypdf import PdfReader
+    return len(PdfReader(io.BytesIO(data)).pages)
+
+
+def extract_text(file) -> str:
+    """
+    Extracts the text of a given PDF file, from the same cached pages as 'iter_pages'.
+
+    :param file: Uploaded file
+    :return: Text of the file
+    """
+    with span("extract_text"):
+        return "".join(iter_pages(file))
+
+
+def iter_chunks(pieces, chunk_size: int, chunk_overlap: int = 0, length_function=len):
+    """
+    Splits a stream of text pieces, such as pages, into chunks as the pieces arrive.
+    Only the text that has not been emitted yet is buffered, so memory stays bounded by a few chunks
+    regardless of the size of the document.
+
+    :param pieces: Iterable of texts that are concatenated in order
+    :param chunk_size: Maximum length of each chunk
+    :param chunk_overlap: Length shared by consecutive chunks
+    :param length_function: Function measuring the length of a text, in characters by default
+    :return: Generator of chunks
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                   length_function=length_function)
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        if length_function(buffer) >= 2 * chunk_size:
+            with span("split"):
+                chunks = text_splitter.split_text(buffer)
+            yield from chunks[:-1]
+            # The chunks are stripped, so the rest of the buffer is carried over from the start of the last chunk
+            # as it is, keeping the whitespace that separates it from the next piece
+            start = buffer.rfind(chunks[-1]) if chunks else len(buffer)
+            buffer = buffer[start:] if start >= 0 else chunks[-1]
+    if buffer.strip():
+        with span("split"):
+            chunks = text_splitter.split_text(buffer)
+        yield from chunks
+
+
+def check_long_text(llm, pieces, context_length: int):
+    """
+    Counts the tokens of a stream of text pieces until they reach the context length of the model.
+    Only the pieces read so far are buffered, so a long text is never tokenized or held in memory whole.
+
+    :param llm: LLM model chosen before
+    :param pieces: Iterable of texts that are concatenated in order
+    :param context_length: The number of tokens a language model can process at once
+    :return: Tuple of a boolean telling whether the text reaches the context length and an iterator over all the pieces
+    """
+    pieces = iter(pieces)
+    read, num_tokens = [], 0
+    for piece in pieces:
+        read.append(piece)
+        num_tokens += get_num_tokens(llm, piece)
+        if num_tokens >= context_length:
+            return True, chain(read, pieces)
+    return False, iter(read)
+
+
+def llm_choice(llm_name: str, key: str, mode: str):
+    """
+    Chooses the LLM model, available models: 'GPT-3.5-turbo-4k', 'GPT-3.5-turbo-16k', 'Mistral-7b', 'Falcon-7b'
+    The clients are created once per model, key and mode and shared by the whole process.
+
+    :param llm_name: Chosen model name
+    :param key: OpenAI or HuggingFace key
+    :param mode: 'sum' for summarization task, 'chat' for chat task, 'data' for Excel or CSV docs, 'llm' for only llm
+    :return: Returns either the LLM alone or the LLM along with the context_length, depending on the mode. The chat task does not require the context_length since only summarization handles long text.
+    """
+    try:
+        models = {
+            "GPT-3.5-turbo-4k": ["gpt-3.5-turbo", 4097],
+            "GPT-3.5-turbo-16k": ["gpt-3.5-turbo-16k", 16385],
+            "Mistral-7b": ["mistralai/Mistral-7B-Instruct-v0.1", 8000],
+            "Falcon-7b": ["tiiuae/falcon-7b-instruct", 1200]
+        }
+        temperature_gpt, temperature_hf = (0, 0.1) if mode == "sum" or mode == "data" else (0.5, 0.5)
+        model_name = models[llm_name][0]
+        context_length = models[llm_name][1]
+        client_key = (llm_name, content_hash(key), mode)
+        llm = _llm_clients.get(client_key)
+        if llm is None:
+            from llm_callbacks import MetricsCallbackHandler
+            callbacks = [MetricsCallbackHandler(model_name)]
+            if model_name.startswith("gpt"):
+                from langchain.chat_models import ChatOpenAI
+                configure_http_pool()
+                llm = ChatOpenAI(temperature=temperature_gpt, model_name=model_name, openai_api_key=key,
+                                 streaming=mode in ("chat", "data"), callbacks=callbacks)
+            else:
+                from langchain.llms import HuggingFaceHub
+                llm = HuggingFaceHub(
+                    repo_id=model_name, model_kwargs={"temperature": temperature_hf, "max_new_tokens": 300},
+                    huggingfacehub_api_token=key, callbacks=callbacks
+                )
+            _llm_clients.set(client_key, llm)
+        if mode == "sum":
+            return llm, context_length
+        else:
+            return llm
+    except Exception as e:
+        st.error(str(e))
+        st.stop()
+
+
+def stream_run(run):
+    """
+    Runs a chain or agent in a background thread and yields the tokens of the answer as the LLM generates them.
+    If the LLM does not stream (e.g. the HuggingFace models), the whole answer is yielded when it is ready.
+    Errors raised by the run are raised again in the calling thread.
+
+    :param run: Function that receives a list of callbacks, runs the chain with them and returns the answer
+    :return: Generator of the pieces of the answer
+    """
+    from llm_callbacks import QueueCallbackHandler
+    token_queue = queue.Queue()
+    done = object()
+    result = {}
+
+    def target():
+        try:
+            result["answer"] = run([QueueCallbackHandler(token_queue)])
+        except Exception as e:
+            result["error"] = e
+        finally:
+            token_queue.put(done)
+
+    threading.Thread(target=bind(target), daemon=True).start()
+    streamed = False
+    while (token := token_queue.get()) is not done:
+        streamed = True
+        yield token
+    if "error" in result:
+        raise result["error"]
+    if not streamed:
+        yield result["answer"]
+
+
+def get_user_id() -> str:
+    """
+    :return: Identifier of the current browser session, used to apply the per-user limits of the background jobs
+    """
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "local"
+
+
+def submit_job(state_key: str, name: str, function) -> None:
+    """
+    Submits a background job for the current user and keeps its ID in 'st.session_state[state_key]',
+    so the next reruns of the page can follow it with 'follow_job'.
+
+    :param state_key: Key of the session state where the job ID is kept
+    :param name: Short description of the job
+    :param function: Function receiving the Job, see 'JobManager.submit'
+    """
+    try:
+        st.session_state[state_key] = job_manager.submit(get_user_id(), name, function).id
+    except Exception as e:
+        st.error(str(e))
+        st.stop()
+
+
+def show_metrics_panel(label: str) -> None:
+    """
+    Shows in the sidebar, when the user turns it on, the metrics of the current session: timings of the stages,
+    LLM calls, tokens, cost, rate limit waits and cache hits, with buttons to download them as JSON lines or in the
+    Prometheus text format.
+
+    :param label: Label of the toggle that shows the panel
+    """
+    if not st.sidebar.toggle(label):
+        return
+    session = session_metrics(get_user_id())
+    rows = [{"metric": sample["name"], "labels": ", ".join(f"{k}={v}" for k, v in sample["labels"].items()),
+             "value": sample.get("value", sample.get("seconds")), "count": sample.get("count")}
+            for sample in session.snapshot()]
+    st.sidebar.dataframe(rows, hide_index=True)
+    st.sidebar.download_button("JSONL", session.to_jsonl(), file_name="metrics.jsonl")
+    st.sidebar.download_button("Prometheus", session.to_prometheus(), file_name="metrics.prom")
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def _job_progress(job_id: str, wait_message: str, cancel_label: str) -> None:
+    """
+    Shows the progress of a running job with a button to cancel it. It runs again on its own every
+    JOB_POLL_INTERVAL seconds without running the rest of the page, and reruns the whole page once the job finishes.
+
+    :param job_id: ID of the job
+    :param wait_message: Message shown while the job runs
+    :param cancel_label: Label of the cancel button
+    """
+    job = job_manager.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    if st.button(cancel_label, key=f"cancel_{job.id}"):
+        job.cancel()
+    st.progress(job.fraction, text=f"{wait_message} {job.message}".strip())
+
+
+def follow_job(state_key: str, wait_message: str, cancel_label: str, cancelled_message: str):
+    """
+    Shows the progress of the background job whose ID is kept in 'st.session_state[state_key]', with a button to
+    cancel it. The page is not blocked while the job runs: the progress is polled by a fragment, so the rest of the
+    page (e.g. downloads, other jobs and the chat) keeps rendering, and the page runs again when the job finishes.
+    Errors and cancellations are shown and the job is forgotten.
+
+    :param state_key: Key of the session state where the job ID is kept
+    :param wait_message: Message shown while the job runs
+    :param cancel_label: Label of the cancel button
+    :param cancelled_message: Message shown when the job has been cancelled
+    :return: The job if it finished successfully, None otherwise
+    """
+    job = job_manager.get(st.session_state.get(state_key))
+    if job is None:
+        return None
+    if not job.finished:
+        _job_progress(job.id, wait_message, cancel_label)
+        return None
+    if job.status == "done":
+        return job
+    del st.session_state[state_key]
+    if job.status == "failed":
+        st.error(str(job.error))
+    else:
+        st.warning(cancelled_message)
+    return None
+
+
+map_prompt = """
+You will be given a single part of a {matter}. This section will be enclosed in triple backticks (```)
+Your goal is to write a very short easy to understand summary {lang}.
+```{text}```
+"""
+
+combine_prompt = """
+You will be given a series of summaries of a {matter}. The summaries will be enclosed in triple backticks (```)
+Your goal is to write a detailed easy to understand summary of the summaries {lang}.
+Additional summary features: {features}
+Note: The additional features might be in spanish or be empty, as they are part of user input. 
+Please take them into account and incorporate those features into your summary. 
+```{text}```
+"""
+
+collapse_prompt = """
+You will be given a series of consecutive summaries of parts of a {matter}. The summaries will be enclosed in triple backticks (```)
+Your goal is to merge them into a single short easy to understand summary {lang}, keeping the order of the ideas.
+```{text}```
+"""
+
+
+def get_model_name(llm) -> str:
+    """
+    Returns the provider model name of an LLM created by 'llm_choice'.
+
+    :param llm: LLM model chosen before
+    :return: OpenAI model name or HuggingFace repository id
+    """
+    return getattr(llm, "model_name", None) or getattr(llm, "repo_id", "")
+
+
+def get_num_tokens(llm, text: str) -> int:
+    """
+    Returns the number of tokens of a text for an LLM created by 'llm_choice', through the cached token counter.
+
+    :param llm: LLM model chosen before
+    :param text: Text to count
+    :return: Number of tokens
+    """
+    return count_tokens(text, get_model_name(llm))
+
+
+def get_summary_cache() -> DiskCache:
+    """
+    Returns the process-wide cache of LLM summaries, creating it on first use.
+
+    :return: DiskCache holding UTF-8 encoded summaries
+    """
+    global _summary_cache
+    if _summary_cache is None:
+        _summary_cache = DiskCache("summaries", max_bytes=SUMMARY_CACHE_MAX_BYTES, ttl=SUMMARY_CACHE_TTL)
+    return _summary_cache
+
+
+def cached_summary(llm, template: str, inputs: dict, run) -> str:
+    """
+    Returns the cached result of a summarization call, or runs it and caches the result.
+    The key is a hash of the model name, the prompt template and the prompt inputs (text, language, matter and
+    features), so a summary is only paid for once while any of them stays the same. Summaries are requested with
+    temperature 0, so the cached output is what the model would answer again.
+
+    :param llm: LLM model chosen before
+    :param template: Prompt template of the call
+    :param inputs: Values of the prompt variables
+    :param run: Function without arguments that makes the LLM call and returns its text
+    :return: Summary
+    """
+    cache = get_summary_cache()
+    key = content_hash(get_model_name(llm), template, json.dumps(inputs, sort_keys=True))
+    cached = cache.get(key)
+    if cached is not None:
+        return cached.decode("utf-8")
+    summary = run()
+    cache.set(key, summary.encode("utf-8"))
+    return summary
+
+
+def get_checkpoint_store() -> DiskCache:
+    """
+    Returns the process-wide store of map checkpoints, creating it on first use.
+
+    :return: DiskCache holding UTF-8 encoded chunk summaries, keyed by summarization run and chunk index
+    """
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = DiskCache("checkpoints", max_bytes=CHECKPOINT_MAX_BYTES, ttl=CHECKPOINT_TTL)
+    return _checkpoint_store
+
+
+def group_summaries(llm, summary_list: list, max_tokens: int) -> list:
+    """
+    Groups consecutive summaries so the joined summaries of each group fit in 'max_tokens'.
+    Every group but the last has at least two summaries, so each level of the tree reduce has fewer summaries than
+    the previous one. When two summaries do not fit together (e.g. long summaries of a model with a small context),
+    both are truncated to half the budget, so no group is ever sent over the context of the model.
+
+    :param llm: LLM model chosen before
+    :param summary_list: Summaries in the order of the document
+    :param max_tokens: Token budget of each group
+    :return: List of groups, each one a list of summaries
+    """
+    model_name = get_model_name(llm)
+    # Each summary is counted with the new line that joins it to the next one
+    half_tokens = max(max_tokens // 2 - 1, 1)
+    groups, groups_tokens, group, group_tokens = [], [], [], 0
+    for summary in summary_list:
+        summary_tokens = get_num_tokens(llm, summary) + 1
+        if len(group) >= 2 and group_tokens + summary_tokens > max_tokens:
+            groups.append(group)
+            groups_tokens.append(group_tokens)
+            group, group_tokens = [], 0
+        if len(group) == 1 and group_tokens + summary_tokens > max_tokens:
+            group = [truncate_tokens(group[0], half_tokens, model_name)]
+            group_tokens = get_num_tokens(llm, group[0]) + 1
+            summary = truncate_tokens(summary, half_tokens, model_name)
+            summary_tokens = get_num_tokens(llm, summary) + 1
+        group.append(summary)
+        group_tokens += summary_tokens
+    if len(group) == 1 and groups and groups_tokens[-1] + group_tokens <= max_tokens:
+        groups[-1].append(group[0])
+    elif len(group) == 1:
+        groups.append([truncate_tokens(group[0], max_tokens, model_name)])
+    elif group:
+        groups.append(group)
+    return groups
+
+
+def handle_long_text(llm, context_length: int, text, lang: str, matter: str, features: str,
+                     max_workers: int = MAX_WORKERS, tree_reduce: bool = True, document_id: str = None,
+                     progress_callback=None, total_pieces: int = None) -> str:
+    """
+    Returns the summary of a very large PDF document.
+    Splits the text of the PDF into chunks as it arrives. The chunks are measured in tokens of the model, so each one
+    fills the context left after the prompt and the expected summary. The chunks are summarized concurrently by a pool of
+    threads while the next chunks are still being produced. Only a few chunks are in flight at the same time.
+    Every call goes through the rate limiter of the model, which keeps the requests and tokens per minute under
+    the provider limits instead of waiting a fixed time after every few chunks.
+    Then, each summary is taken in the original order of the chunks, and the summary of these summaries is returned.
+    With 'tree_reduce', if the joined summaries do not fit in the context of the model, consecutive summaries are
+    grouped by token budget and each group is collapsed into one summary in parallel, level by level, until they fit.
+    All the summaries go through the summary cache, so when a document is summarized
+    again only the chunks that changed reach the LLM.
+    With a 'document_id', the summary of every chunk is also checkpointed as soon as it completes, keyed by the document,
+    the summarization settings and the chunk index. If a call fails midway, the chunks already in flight still finish
+    and are checkpointed, and a retried run skips every checkpointed chunk without even looking at the summary
+    cache, so only the missing chunks reach the LLM before reducing. The checkpoints are removed once the final summary
+    is ready.
+    A 'progress_callback' is called in the calling thread every time a chunk summary completes, and before every
+    level of the reduction. If it raises an exception (e.g. when a background job is cancelled), the chunks not
+    started yet are skipped, and the chunks in flight finish and are checkpointed, so the run can be resumed.
+
+    :param llm: LLM model chosen before
+    :param context_length: The number of tokens a language model can process at once
+    :param text: Text of the large PDF document, or an iterable of its pieces (e.g. pages)
+    :param lang: Chosen language
+    :param matter: 'text' if it is a document summarization, 'data about a YouTube video transcription' if it is a YouTube video summarization
+    :param features: Additional features for the summaries
+    :param max_workers: Maximum number of chunks summarized at the same time
+    :param tree_reduce: Collapse the summaries level by level when they do not fit in the context of the model
+    :param document_id: Hash of the document content, enables the checkpoints of the chunk summaries
+    :param progress_callback: Optional function called as 'progress_callback(done, total, "")' with the number of
+        chunks summarized so far. The total is estimated from the tokens of the text when it is given as a string or a
+        list. While the text is streaming, it is extrapolated from the chunks made out of the pieces read so far when
+        'total_pieces' is given, and it is None otherwise
+    :param total_pieces: Number of pieces of a streamed text, e.g. the pages of a PDF
+    :return: Summary of the summaries of the large PDF document
+    """
+    from langchain.prompts import PromptTemplate
+    from langchain.chains.summarize import load_summarize_chain
+    from langchain.schema import Document
+    pieces = [text] if isinstance(text, str) else text
+    pieces_read = 0
+
+    def counted(stream):
+        nonlocal pieces_read
+        for piece in stream:
+            pieces_read += 1
+            yield piece
+    if progress_callback is not None and total_pieces and not isinstance(pieces, list):
+        pieces = counted(pieces)
+    chunk_tokens = max(context_length - MAP_COMPLETION_TOKENS - get_num_tokens(llm, map_prompt) - MIN_PROMPT_MARGIN,
+                       MIN_PROMPT_MARGIN)
+    chunks = iter_chunks(pieces, chunk_size=chunk_tokens, length_function=token_length_function(get_model_name(llm)))
+    map_prompt_template = PromptTemplate(template=map_prompt, input_variables=["text", "lang", "matter"])
+    combine_prompt_template = PromptTemplate(template=combine_prompt,
+                                             input_variables=["lang", "matter", "text", "features"])
+    map_chain = load_summarize_chain(llm=llm, chain_type="stuff", prompt=map_prompt_template)
+    rate_limiter = get_rate_limiter(get_model_name(llm))
+
+    checkpoints = get_checkpoint_store() if document_id is not None else None
+    run_key = content_hash(document_id or "", get_model_name(llm), map_prompt, lang, matter,
+                           str(chunk_tokens))
+
+    def summarize_chunk(index: int, chunk: str) -> str:
+        def run() -> str:
+            doc = Document(page_content=chunk)
+            rate_limiter.acquire(get_num_tokens(llm, chunk) + MAP_COMPLETION_TOKENS)
+            return map_chain.run({'text': [doc], 'matter': matter, 'lang': lang, 'input_documents': [doc]})
+        summary = cached_summary(llm, map_prompt, {'text': chunk, 'matter': matter, 'lang': lang}, run)
+        if checkpoints is not None:
+            checkpoints.set(content_hash(run_key, str(index)), summary.encode("utf-8"))
+        return summary
+
+    collapse_prompt_template = PromptTemplate(template=collapse_prompt, input_variables=["text", "lang", "matter"])
+    collapse_chain = load_summarize_chain(llm=llm, chain_type="stuff", prompt=collapse_prompt_template)
+
+    def collapse_group(group: list) -> str:
+        group_text = "\n".join(group)
+
+        def run() -> str:
+            doc = Document(page_content=group_text)
+            rate_limiter.acquire(get_num_tokens(llm, group_text) + MAP_COMPLETION_TOKENS)
+            return collapse_chain.run({'text': [doc], 'matter': matter, 'lang': lang, 'input_documents': [doc]})
+        return cached_summary(llm, collapse_prompt, {'text': group_text, 'matter': matter, 'lang': lang}, run)
+
+    reduce_budget = context_length - MAP_COMPLETION_TOKENS - get_num_tokens(llm, combine_prompt + features)
+    summary_by_index = {}
+    estimated_chunks = None
+    if progress_callback is not None and isinstance(pieces, list):
+        estimated_chunks = -(-sum(get_num_tokens(llm, piece) for piece in pieces) // chunk_tokens)
+
+    chunks_made = 0
+
+    def report() -> None:
+        if progress_callback is not None:
+            done = len(summary_by_index)
+            total = estimated_chunks
+            if total is None and pieces_read:
+                total = round(chunks_made * total_pieces / pieces_read)
+            progress_callback(done, max(total, done) if total is not None else None, "")
+
+    with span("map"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        try:
+            for index, chunk in enumerate(chunks):
+                chunks_made = index + 1
+                saved = checkpoints.get(content_hash(run_key, str(index))) if checkpoints is not None else None
+                if saved is not None:
+                    summary_by_index[index] = saved.decode("utf-8")
+                    report()
+                    continue
+                pending[executor.submit(bind(summarize_chunk), index, chunk)] = index
+                if len(pending) >= max_workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        summary_by_index[pending.pop(future)] = future.result()
+                    report()
+            for future in list(pending):
+                summary_by_index[pending.pop(future)] = future.result()
+                report()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+        summary_list = [summary_by_index[index] for index in range(len(summary_by_index))]
+        while tree_reduce and len(summary_list) > 1 and get_num_tokens(llm, "\n".join(summary_list)) > reduce_budget:
+            report()
+            summary_list = list(executor.map(bind(collapse_group), group_summaries(llm, summary_list, reduce_budget)))
+    report()
+    summaries = "\n".join(summary_list)
+    summaries = Document(page_content=summaries)
+
+    reduce_chain = load_summarize_chain(llm=llm, chain_type="stuff", prompt=combine_prompt_template)
+
+    def reduce() -> str:
+        rate_limiter.acquire(get_num_tokens(llm, summaries.page_content) + MAP_COMPLETION_TOKENS)
+        return reduce_chain.run({'lang': lang, 'matter': matter,
+                                 'text': [summaries], 'input_documents': [summaries], 'features': features})
+    with span("reduce"):
+        summary = cached_summary(llm, combine_prompt, {'text': summaries.page_content, 'matter': matter,
+                                                       'lang': lang, 'features': features}, reduce)
+    if checkpoints is not None:
+        for index in range(len(summary_by_index)):
+            checkpoints.delete(content_hash(run_key, str(index)))
+    return summary
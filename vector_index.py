@@ -0,0 +1,287 @@
+import os
+import pickle
+import time
+
+import faiss
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from cache import CACHE_DIR, MemoryCache, content_hash, bound_directory, touch
+
+# Directory where the FAISS index of every indexed document is saved
+INDEX_DIR = os.path.join(CACHE_DIR, "indexes")
+# Maximum total size of the saved document indexes, the least recently used are deleted first
+INDEX_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def document_key(embedding_model: str, file=None, video_id: str = None, text: str = None) -> str:
+    """
+    Returns the key of a document index: a hash of the embedding model and the file content, the video ID or the text.
+
+    :param embedding_model: Name of the embedding model used to build the index
+    :param file: Uploaded file
+    :param video_id: YouTube video ID
+    :param text: Text of the document, used when there is neither a file nor a video ID
+    :return: Hex digest identifying the document index
+    """
+    if file is not None:
+        return content_hash(embedding_model, "file", file.getvalue())
+    if video_id is not None:
+        return content_hash(embedding_model, "video", video_id)
+    return content_hash(embedding_model, "text", text)
+
+
+def save_document_index(doc_key: str, store: FAISS) -> None:
+    """
+    Saves the FAISS store of a document inside INDEX_DIR, and deletes the least recently used indexes if the
+    directory grows past INDEX_MAX_BYTES.
+
+    :param doc_key: Key of the document
+    :param store: FAISS store holding only that document
+    """
+    store.save_local(os.path.join(INDEX_DIR, doc_key))
+    bound_directory(INDEX_DIR, INDEX_MAX_BYTES, keep=(doc_key,))
+
+
+def has_document_index(doc_key: str) -> bool:
+    """
+    :param doc_key: Key of the document
+    :return: Whether the index of the document is saved, it may have been deleted to bound INDEX_DIR
+    """
+    return os.path.exists(os.path.join(INDEX_DIR, doc_key, "index.faiss"))
+
+
+def load_document_index(doc_key: str, embeddings):
+    """
+    Loads the saved FAISS store of a document and marks it as recently used.
+
+    :param doc_key: Key of the document
+    :param embeddings: Embeddings model used for the queries
+    :return: FAISS store, or None if the document has not been indexed before
+    """
+    folder = os.path.join(INDEX_DIR, doc_key)
+    index_path = os.path.join(folder, "index.faiss")
+    if not os.path.exists(index_path):
+        return None
+    touch(folder)
+    index = faiss.read_index(index_path)
+    with open(os.path.join(folder, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+# Corpus sizes (number of vectors) of the selected documents from which each index type is chosen automatically
+INDEX_THRESHOLDS = [(1000000, "ivfpq"), (100000, "ivf"), (20000, "hnsw"), (0, "flat")]
+# Number of neighbors of each node of the HNSW graph and size of its search queue
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+# Number of sub-quantizers of IVF-PQ, it must divide the dimension of the vectors
+PQ_M = 64
+# IVF-PQ searches PQ_REFINE_FACTOR times more candidates and re-ranks them with 8-bit scalar quantized vectors
+PQ_REFINE_FACTOR = 16
+# Fraction of the IVF lists visited by each search
+IVF_PROBE_FRACTION = 1 / 16
+# Minimum recall@4 an automatically chosen approximate index must reach, else a more exact type is used
+MIN_RECALL = 0.9
+# Number of stored vectors used as queries to measure that recall
+RECALL_SAMPLE = 100
+
+
+def choose_index_type(num_vectors: int) -> str:
+    """
+    Chooses the index type for a corpus size according to INDEX_THRESHOLDS.
+
+    :param num_vectors: Number of vectors in the corpus
+    :return: 'flat', 'hnsw', 'ivf' or 'ivfpq'
+    """
+    for threshold, index_type in INDEX_THRESHOLDS:
+        if num_vectors >= threshold:
+            return index_type
+    return "flat"
+
+
+def get_index_type(index) -> str:
+    """
+    :param index: FAISS index
+    :return: 'flat', 'hnsw', 'ivf' or 'ivfpq'
+    """
+    if isinstance(index, faiss.IndexRefine):
+        index = faiss.downcast_index(index.base_index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def build_index(vectors: np.ndarray, index_type: str):
+    """
+    Builds a FAISS index of the given type with the vectors, training it first if the type needs it.
+    Search parameters are set so the approximate indexes keep a high recall, and IVF-PQ results are re-ranked with
+    finer vectors since the product quantized distances alone miss most of the true neighbors.
+
+    :param vectors: float32 array of shape (number of vectors, dimension)
+    :param index_type: 'flat', 'hnsw', 'ivf' or 'ivfpq'
+    :return: FAISS index holding the vectors
+    """
+    num_vectors, dimension = vectors.shape
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif index_type in ("ivf", "ivfpq"):
+        nlist = max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == "ivfpq" and dimension % PQ_M == 0:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, PQ_M, 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        index.train(vectors)
+        index.nprobe = max(1, int(nlist * IVF_PROBE_FRACTION))
+        index.make_direct_map()
+        if isinstance(index, faiss.IndexIVFPQ):
+            index = faiss.IndexRefine(index, faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit))
+            index.train(vectors)
+            index.k_factor = PQ_REFINE_FACTOR
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    index.add(vectors)
+    return index
+
+
+def measure_recall(index, vectors: np.ndarray, queries: np.ndarray, k: int = 4) -> float:
+    """
+    Measures the recall@k of an index against an exact search of the same vectors.
+
+    :param index: FAISS index holding the vectors
+    :param vectors: float32 array with the corpus
+    :param queries: float32 array with the queries
+    :param k: Number of neighbors retrieved by each query
+    :return: Fraction of the exact k nearest neighbors the index finds
+    """
+    _, expected = build_index(vectors, "flat").search(queries, k)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(expected[i]) & set(found[i])) for i in range(len(queries)))
+    return hits / (len(queries) * k)
+
+
+def build_index_auto(vectors: np.ndarray):
+    """
+    Builds the index type chosen for the corpus size, falling back to the next more exact type while the recall
+    measured on RECALL_SAMPLE of the vectors stays below MIN_RECALL.
+
+    :param vectors: float32 array of shape (number of vectors, dimension)
+    :return: FAISS index holding the vectors
+    """
+    index_types = [index_type for _, index_type in INDEX_THRESHOLDS]
+    start = index_types.index(choose_index_type(len(vectors)))
+    sample = np.random.default_rng(0).choice(len(vectors), min(RECALL_SAMPLE, len(vectors)), replace=False)
+    for index_type in index_types[start:-1]:
+        index = build_index(vectors, index_type)
+        if measure_recall(index, vectors, vectors[sample]) >= MIN_RECALL:
+            return index
+    return build_index(vectors, "flat")
+
+
+def store_vectors(store: FAISS) -> np.ndarray:
+    """
+    Returns the vectors of a FAISS store, in the order of its index. For PQ indexes the vectors are approximate.
+
+    :param store: FAISS store
+    :return: float32 array of shape (number of vectors, dimension)
+    """
+    return store.index.reconstruct_n(0, store.index.ntotal)
+
+
+def combine_stores(stores: list, index_type: str = None) -> FAISS:
+    """
+    Builds a single FAISS store holding the chunks of several stores.
+
+    :param stores: FAISS stores, e.g. those of the selected documents
+    :param index_type: Index type of the new store, chosen from its size and the recall it reaches if None
+    :return: FAISS store with the chunks of all the stores
+    """
+    vectors = np.concatenate([store_vectors(store) for store in stores])
+    index = build_index(vectors, index_type) if index_type else build_index_auto(vectors)
+    docstore = InMemoryDocstore()
+    index_to_docstore_id = {}
+    for store in stores:
+        ids = [store.index_to_docstore_id[i] for i in range(store.index.ntotal)]
+        docstore.add({doc_id: store.docstore.search(doc_id) for doc_id in ids})
+        index_to_docstore_id.update(enumerate(ids, start=len(index_to_docstore_id)))
+    return FAISS(stores[0].embedding_function, index, docstore, index_to_docstore_id)
+
+
+def compare_index_types(vectors: np.ndarray, queries: np.ndarray, k: int = 4,
+                        index_types: tuple = ("flat", "hnsw", "ivf", "ivfpq")) -> list:
+    """
+    Measures the recall and latency of each index type against the exact flat baseline.
+
+    :param vectors: float32 array with the corpus
+    :param queries: float32 array with the queries
+    :param k: Number of neighbors retrieved by each query
+    :param index_types: Index types to compare
+    :return: List of dictionaries with the index type, build seconds, recall@k, milliseconds per query and size in bytes
+    """
+    report = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        index.search(queries, k)
+        search_seconds = time.perf_counter() - start
+        report.append({
+            "index_type": get_index_type(index),
+            "build_seconds": build_seconds,
+            "recall_at_k": measure_recall(index, vectors, queries, k),
+            "ms_per_query": 1000 * search_seconds / len(queries),
+            "bytes": faiss.serialize_index(index).nbytes
+        })
+    return report
+
+
+# Combined stores of selected documents kept in memory, shared by every session selecting the same documents
+COMBINED_STORES_CACHED = 8
+_combined_stores = MemoryCache(max_entries=COMBINED_STORES_CACHED)
+
+
+class DocumentsRetriever(BaseRetriever):
+    """
+    Retriever over several document indexes: the question is embedded once, every index is searched for its closest
+    chunks, and the k closest of all of them are kept. The indexes are searched directly, so selecting a few documents
+    does not depend on how many other documents have been indexed.
+    Every document has an exact flat index. When the selected documents together pass the first approximate
+    threshold of INDEX_THRESHOLDS, they are searched through one combined index of the type chosen for their total
+    size instead, built on the first question and then shared by the sessions selecting the same documents.
+    """
+
+    embeddings: Embeddings
+    documents: list
+    load_store: object
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> list:
+        """
+        :param query: Question
+        :return: The k chunks closest to the question among the documents, closest first
+        """
+        vector = self.embeddings.embed_query(query)
+        combined_key = content_hash(*self.documents)
+        stores = [_combined_stores.get(combined_key)]
+        if stores[0] is None:
+            stores = [self.load_store(doc_key) for doc_key in self.documents]
+            if all(store is not None for store in stores) and \
+                    choose_index_type(sum(store.index.ntotal for store in stores)) != "flat":
+                stores = [combine_stores(stores)]
+                _combined_stores.set(combined_key, stores[0])
+        results = []
+        for store in stores:
+            if store is not None:
+                results.extend(store.similarity_search_with_score_by_vector(vector, k=self.k))
+        results.sort(key=lambda result: result[1])
+        return [document for document, _ in results[:self.k]]